@@ -1,5 +1,7 @@
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.utils import timezone
 from rest_framework import (
     authentication,
     exceptions
@@ -7,13 +9,155 @@ from rest_framework import (
 from base64 import b64decode
 from keystoneauth1 import session
 from keystoneauth1.identity import v3
+from requests.adapters import HTTPAdapter
+from .cache import LRUCache
 from .utils import openstack
+from types import MappingProxyType
+import copy
+import hashlib
 import logging
 import json
+import requests
+import threading
 
 
 logger = logging.getLogger(__package__)
 
+_http_adapter = None
+_http_adapter_lock = threading.Lock()
+
+_os_conn_cache = LRUCache(maxsize=settings.OS_CONN_CACHE_SIZE)
+
+_account_info_cache = LRUCache(
+    maxsize=settings.ACCOUNT_INFO_CACHE_SIZE,
+    ttl=settings.ACCOUNT_INFO_CACHE_TTL)
+_auth_user_cache = LRUCache(
+    maxsize=settings.ACCOUNT_INFO_CACHE_SIZE,
+    ttl=settings.ACCOUNT_INFO_CACHE_TTL)
+
+
+def _get_http_adapter():
+    """HTTP adapter shared by all keystone sessions, so that tcp/tls
+    connections to keystone and service endpoints are pooled across tokens."""
+    global _http_adapter
+    if _http_adapter is None:
+        with _http_adapter_lock:
+            if _http_adapter is None:
+                _http_adapter = HTTPAdapter(
+                    pool_connections=settings.OS_HTTP_POOL_SIZE,
+                    pool_maxsize=settings.OS_HTTP_POOL_SIZE)
+    return _http_adapter
+
+
+def _new_http_session():
+    """requests session of one token: its cookies are not shared with the
+    other tokens, only the connection pool of the adapter is."""
+    http_session = requests.Session()
+    adapter = _get_http_adapter()
+    http_session.mount('http://', adapter)
+    http_session.mount('https://', adapter)
+    return http_session
+
+
+def _get_token_ttl(os_auth, os_session):
+    try:
+        expires = os_auth.get_access(os_session).expires
+    except Exception as exc:
+        logger.warning(f"failed to get openstack token expiry: {exc}")
+        return settings.OS_CONN_CACHE_TTL
+    ttl = (expires - timezone.now()).total_seconds() - settings.OS_CONN_EXPIRY_SKEW
+    return max(ttl, 0)
+
+
+def get_os_connection(token, project_id, region_name=None):
+    """Get a cached openstack connection for (token, project_id, region).
+
+    Entries expire with the token and the least recently used ones are
+    evicted once OS_CONN_CACHE_SIZE is reached.
+    """
+    region_name = region_name or settings.OS_REGION_NAME
+    key = (token, project_id, region_name)
+    os_conn = _os_conn_cache.get(key)
+    if os_conn is None:
+        os_auth = v3.Token(
+            auth_url=settings.OS_AUTH_URL,
+            token=token,
+            project_id=project_id,
+            project_domain_name=settings.OS_PROJECT_DOMAIN_NAME,
+        )
+        os_session = session.Session(auth=os_auth, session=_new_http_session())
+        os_conn = openstack.connection.Connection(
+            session=os_session,
+            identity_api_version=settings.OS_IDENTITY_API_VERSION,
+            interface=settings.OS_INTERFACE,
+            region_name=region_name,
+        )
+        _os_conn_cache.set(key, os_conn, ttl=_get_token_ttl(os_auth, os_session))
+        logger.debug(f"openstack connection cache: {_os_conn_cache.stats()}")
+    return os_conn
+
+
+def get_os_connection_cache_stats():
+    return _os_conn_cache.stats()
+
+
+def _freeze(value):
+    """Read-only view of decoded json, safe to share between requests."""
+    if isinstance(value, dict):
+        return MappingProxyType({k: _freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+def _decode_account_info(header):
+    key = hashlib.sha1(header.encode()).hexdigest()
+    account_info = _account_info_cache.get(key)
+    if account_info is None:
+        account_info = _freeze(json.loads(b64decode(header)))
+        _account_info_cache.set(key, account_info)
+    return account_info
+
+
+def _get_shared_cache():
+    if settings.ACCOUNT_INFO_SHARED_CACHE:
+        return caches[settings.ACCOUNT_INFO_SHARED_CACHE]
+    return None
+
+
+def _get_or_update_user(account_info):
+    """Upsert the auth user only when its account fields changed.
+
+    Every request gets its own copy of the cached user.
+    """
+    user_id = account_info['id']
+    defaults = {
+        'username': account_info['loginName'],
+        'first_name': account_info['accountName'],
+        'is_staff': bool(account_info['isPlatform'])
+    }
+    cached = _auth_user_cache.get(user_id)
+    shared_cache = _get_shared_cache()
+    shared_key = f"auth-user:{user_id}"
+    if cached is None and shared_cache is not None:
+        cached = shared_cache.get(shared_key)
+    if cached is not None and cached[0] == defaults:
+        _auth_user_cache.set(user_id, cached)
+        return copy.copy(cached[1])
+
+    user, created = User.objects.update_or_create(id=user_id, defaults=defaults)
+    _auth_user_cache.set(user_id, (defaults, user))
+    if shared_cache is not None:
+        shared_cache.set(shared_key, (defaults, user), settings.ACCOUNT_INFO_CACHE_TTL)
+    return copy.copy(user)
+
+
+def get_account_info_cache_stats():
+    return {
+        'account_info': _account_info_cache.stats(),
+        'auth_user': _auth_user_cache.stats(),
+    }
+
 
 class AccountInfoAuthentication(authentication.BaseAuthentication):
     ACCOUNT_INFO_KEY = settings.ACCOUNT_INFO_KEY
@@ -23,18 +167,13 @@ class AccountInfoAuthentication(authentication.BaseAuthentication):
             if self.ACCOUNT_INFO_KEY not in request.headers:
                 raise KeyError(f"{self.ACCOUNT_INFO_KEY} is missing")
 
-            account_info = json.loads(b64decode(request.headers[self.ACCOUNT_INFO_KEY]))
+            account_info = _decode_account_info(request.headers[self.ACCOUNT_INFO_KEY])
         except Exception as exc:
             msg = f"invalid request header: {exc}"
             logger.error(msg)
             raise exceptions.AuthenticationFailed(msg)
         else:
-            user, created = User.objects.update_or_create(
-                id=account_info['id'], defaults={
-                    'username': account_info['loginName'],
-                    'first_name': account_info['accountName'],
-                    'is_staff': bool(account_info['isPlatform'])
-                })
+            user = _get_or_update_user(account_info)
             request.account_info = account_info
             request.tenant = {
                 'id': account_info.get('tenantId'),
@@ -52,18 +191,9 @@ class OSAuthentication(AccountInfoAuthentication):
             if self.OS_TOKEN_KEY not in request.headers:
                 raise KeyError(f"{self.OS_TOKEN_KEY} is missing")
 
-            os_auth = v3.Token(
-                auth_url=settings.OS_AUTH_URL,
-                token=request.headers[self.OS_TOKEN_KEY],
-                project_id=request.account_info['currentTenantCloudRel']['projectId'],
-                project_domain_name=settings.OS_PROJECT_DOMAIN_NAME,
-            )
-            request.os_conn = openstack.connection.Connection(
-                session=session.Session(auth=os_auth),
-                identity_api_version=settings.OS_IDENTITY_API_VERSION,
-                interface=settings.OS_INTERFACE,
-                region_name=settings.OS_REGION_NAME,
-            )
+            request.os_conn = get_os_connection(
+                request.headers[self.OS_TOKEN_KEY],
+                request.account_info['currentTenantCloudRel']['projectId'])
         except Exception as exc:
             msg = f"invalid request header: {exc}"
             logger.error(msg)
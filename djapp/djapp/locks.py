@@ -0,0 +1,52 @@
+from contextlib import contextmanager
+from django.db import connection
+import hashlib
+
+
+def is_supported():
+    return connection.vendor == 'postgresql'
+
+
+def advisory_key(*parts):
+    """Signed 64 bits postgres advisory lock key of `parts`."""
+    digest = hashlib.sha1(':'.join(str(p) for p in parts).encode()).digest()
+    return int.from_bytes(digest[:8], 'big', signed=True)
+
+
+def _call(func, key):
+    with connection.cursor() as cursor:
+        cursor.execute(f'SELECT {func}(%s)', [key])
+        return cursor.fetchone()[0]
+
+
+def try_lock(key):
+    return _call('pg_try_advisory_lock', key)
+
+
+def lock(key):
+    _call('pg_advisory_lock', key)
+
+
+def unlock(key):
+    _call('pg_advisory_unlock', key)
+
+
+@contextmanager
+def slot(name, limit):
+    """Hold one of the `limit` session advisory locks of `name`.
+
+    Yield the slot number, or None when all of them are taken. Other
+    database backends are not bounded and always get slot 0.
+    """
+    if not is_supported():
+        yield 0
+        return
+    for number in range(limit):
+        key = advisory_key(name, 'slot', number)
+        if try_lock(key):
+            try:
+                yield number
+            finally:
+                unlock(key)
+            return
+    yield None
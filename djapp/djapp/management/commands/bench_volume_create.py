@@ -0,0 +1,80 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from types import SimpleNamespace
+from djapp.models import Volume
+import threading
+import time
+import uuid
+
+
+class _StubCinder:
+    """Connection stand-in answering volume creations after `latency` seconds."""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+        self.volume = self
+
+    def create_volume(self, size, name=None, volume_type=None):
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(self.latency)
+        with self._lock:
+            self.in_flight -= 1
+        return SimpleNamespace(
+            id=uuid.uuid4(), name=name, description=None, size=size,
+            location=SimpleNamespace(project=SimpleNamespace(id=uuid.uuid4().hex)),
+            is_bootable=False, volume_type=volume_type, status='creating',
+            attachments=[], host=None)
+
+
+def _row(volume):
+    return Volume(id=volume.id, name=volume.name, size=volume.size,
+                  project_id=volume.location.project.id,
+                  volume_type=volume.volume_type, status=volume.status,
+                  attachments=volume.attachments, is_bootable=volume.is_bootable)
+
+
+class Command(BaseCommand):
+    help = "Benchmark the batch volume creation against a stub cinder"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--counts', nargs='+', type=int, default=[1, 10, 50])
+        parser.add_argument('--latency', type=float, default=0.2,
+                            help="stub cinder latency of a creation, in seconds")
+        parser.add_argument('--concurrency', type=int,
+                            default=settings.VOLUME_CREATE_CONCURRENCY)
+        parser.add_argument('--no-db', action='store_true',
+                            help="skip the (rolled back) row inserts")
+
+    def _run(self, count, concurrency, bulk, latency, db):
+        os_conn = _StubCinder(latency)
+        start = time.perf_counter()
+        created = Volume.create_volumes(os_conn, count, size=1, name='bench',
+                                        volume_type='bench', concurrency=concurrency)
+        rows = [_row(volume) for volume, exc in created if exc is None]
+        if db:
+            with transaction.atomic():
+                if bulk:
+                    Volume.objects.bulk_create(rows)
+                else:
+                    for row in rows:
+                        row.save(force_insert=True)
+                transaction.set_rollback(True)
+        return time.perf_counter() - start, os_conn.max_in_flight
+
+    def handle(self, *args, **kwargs):
+        latency = kwargs['latency']
+        concurrency = kwargs['concurrency']
+        db = not kwargs['no_db']
+        for count in kwargs['counts']:
+            serial, _ = self._run(count, 1, False, latency, db)
+            batch, in_flight = self._run(count, concurrency, True, latency, db)
+            self.stdout.write(
+                f"count: {count:4d}  serial: {serial:.3f}s  "
+                f"batch: {batch:.3f}s (max in flight: {in_flight})  "
+                f"speedup: {serial / batch:.1f}x")
@@ -1,3 +1,4 @@
+from concurrent.futures import ThreadPoolExecutor
 from django.conf import settings
 from django.contrib.postgres.indexes import BrinIndex
 from django.db import models
@@ -5,8 +6,8 @@ from django.utils.translation import gettext_lazy as _
 from netfields import CidrAddressField, InetAddressField,\
     MACAddressField, NetManager
 from .utils import FirewallMixin, StaticRoutingNetConfMixin, OpenstackMixin
+import openstack
 import uuid
-from threading import Thread
 
 
 class Network(models.Model, OpenstackMixin):
@@ -280,6 +281,10 @@ class Port(models.Model, OpenstackMixin):
         max_length=255,
         null=True)
     in_use = models.BooleanField(default=False)
+    # neutron update time of the last applied change
+    os_updated_at = models.DateTimeField(
+        null=True,
+        verbose_name=_('openstack updated time'))
 
     creater = models.ForeignKey(
         settings.AUTH_USER_MODEL,
@@ -604,6 +609,22 @@ class Volume(models.Model, OpenstackMixin):
         null=True,
         max_length=255
     )
+    # cinder update time of the last applied change
+    os_updated_at = models.DateTimeField(
+        null=True,
+        verbose_name=_('openstack updated time'))
+    # celery job of the operation queued or running on the volume
+    job_id = models.CharField(
+        null=True,
+        max_length=255
+    )
+    job_operation = models.CharField(
+        null=True,
+        max_length=255
+    )
+    job_queued_at = models.DateTimeField(
+        null=True
+    )
     created_at = models.DateTimeField(
         auto_now_add=True,
         verbose_name=_('created time'))
@@ -632,6 +653,23 @@ class Volume(models.Model, OpenstackMixin):
         volume = os_conn.volume.create_volume(size=size, name=name, volume_type=volume_type)
         return volume
 
+    @classmethod
+    def create_volumes(cls, os_conn, count, size, name=None, volume_type=None, concurrency=1):
+        """Create `count` volumes with at most `concurrency` requests in flight.
+
+        Return a (volume, error) pair per requested volume, in order. Any
+        failure, an api error as well as a connection failure or timeout,
+        is the error of its volume: the others may be created already.
+        """
+        def _create(_):
+            try:
+                return cls.create_volume(os_conn, size, name=name, volume_type=volume_type), None
+            except Exception as exc:
+                return None, exc
+
+        with ThreadPoolExecutor(max_workers=max(1, min(count, concurrency))) as executor:
+            return list(executor.map(_create, range(count)))
+
     def destroy_volume(self, os_conn):
         os_conn.volume.delete_volume(self.id, ignore_missing=False)
 
@@ -639,28 +677,15 @@ class Volume(models.Model, OpenstackMixin):
         update_volume = os_conn.update_volume(self.id, name=name)
         return update_volume
 
-    def async_attached(f):
-        def wrapper(*args, **kwargs):
-            thr = Thread(target=f, args=args, kwargs=kwargs)
-            thr.start()
-        return wrapper
-
-    @async_attached
     def attached_volume(self, os_conn, server_id):
-        server = os_conn.compute.get_server(server_id)
-        volume = os_conn.get_volume(self.id)
-        attached = os_conn.attach_volume(server=server, volume=volume)
+        attached = os_conn.compute.create_volume_attachment(server_id, volume=str(self.id))
         return attached
 
-    @async_attached
     def detached_volume(self, os_conn, server_id):
-        server = os_conn.compute.get_server(server_id)
-        volume = os_conn.get_volume(self.id)
-        os_conn.detach_volume(server=server, volume=volume)
+        os_conn.compute.delete_volume_attachment(server_id, str(self.id), ignore_missing=False)
 
     def extend_volume(self, os_conn, new_size):
-        volume = os_conn.get_volume(self.id)
-        os_conn.volume.extend_volume(volume, size=new_size)
+        os_conn.volume.extend_volume(str(self.id), size=new_size)
 
 
 class VolumeType(models.Model, OpenstackMixin):
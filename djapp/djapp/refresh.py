@@ -0,0 +1,98 @@
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import close_old_connections
+from .cache import LRUCache
+import logging
+import os
+import threading
+
+
+logger = logging.getLogger(__package__)
+
+# (kind, pk) of the rows refreshed less than LIST_REFRESH_TTL seconds ago
+_refreshed = LRUCache(maxsize=settings.LIST_REFRESH_CACHE_SIZE,
+                      ttl=settings.LIST_REFRESH_TTL)
+# (kind, pk) of the rows queued or being refreshed
+_pending = set()
+_pending_lock = threading.Lock()
+_dropped = 0
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ThreadPoolExecutor(
+                    max_workers=settings.LIST_REFRESH_WORKERS,
+                    thread_name_prefix='list-refresh')
+    return _pool
+
+
+def _reset_pool():
+    global _pool, _pool_lock, _pending, _pending_lock
+    _pool = None
+    _pool_lock = threading.Lock()
+    _pending = set()
+    _pending_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_pool)
+
+
+def _run(kind, obj, refresh_fn):
+    key = (kind, obj.pk)
+    try:
+        refresh_fn(obj)
+        _refreshed.set(key, True)
+    except Exception as exc:
+        logger.warning(f"refresh {kind} {obj.pk} failed: {exc}")
+    finally:
+        with _pending_lock:
+            _pending.discard(key)
+        # pool threads keep their db connection between refreshes
+        close_old_connections()
+
+
+def _reserve(key):
+    """Mark `key` pending, False when it already is or the queue is full."""
+    global _dropped
+    with _pending_lock:
+        if key in _pending:
+            return False
+        if len(_pending) >= settings.LIST_REFRESH_MAX_PENDING:
+            _dropped += 1
+            return False
+        _pending.add(key)
+        return True
+
+
+def schedule(kind, objs, refresh_fn):
+    """Run `refresh_fn(obj)` in the background pool for the `objs` not
+    refreshed within LIST_REFRESH_TTL seconds, return how many were queued.
+
+    A row is marked fresh once refreshed, a failed refresh is retried by
+    the next list. Rows already queued are not queued again, and none are
+    queued beyond LIST_REFRESH_MAX_PENDING: the next lists pick them up.
+    """
+    queued = 0
+    for obj in objs:
+        key = (kind, obj.pk)
+        if _refreshed.get(key) or not _reserve(key):
+            continue
+        try:
+            _get_pool().submit(_run, kind, obj, refresh_fn)
+        except Exception:
+            with _pending_lock:
+                _pending.discard(key)
+            raise
+        queued += 1
+    return queued
+
+
+def stats():
+    result = _refreshed.stats()
+    result.update(pending=len(_pending), dropped=_dropped)
+    return result
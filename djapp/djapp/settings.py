@@ -229,6 +229,12 @@ OS_AUTH_PLUGIN = os.getenv('OS_AUTH_PLUGIN', 'password')
 
 OS_TOKEN_KEY = os.getenv('OPENSTACK_TOKEN_KEY', 'Os-Token')
 
+# per-token openstack connection cache
+OS_CONN_CACHE_SIZE = int(os.getenv('OS_CONN_CACHE_SIZE', 256))
+OS_CONN_CACHE_TTL = int(os.getenv('OS_CONN_CACHE_TTL', 600))  # used when token expiry is unknown
+OS_CONN_EXPIRY_SKEW = int(os.getenv('OS_CONN_EXPIRY_SKEW', 60))
+OS_HTTP_POOL_SIZE = int(os.getenv('OS_HTTP_POOL_SIZE', 10))
+
 # OS_AUTH_URL = os.getenv('OS_AUTH_URL', 'http://127.0.0.1:35357/v3')
 
 # OS_PROJECT_DOMAIN_NAME = os.getenv('OS_PROJECT_DOMAIN_NAME', 'Default')
@@ -255,9 +261,58 @@ NETCONF_PASSWORD = os.getenv('NETCONF_PASSWORD', 'NETCONF_PASSWORD')
 
 ACCOUNT_INFO_KEY = os.getenv('ACCOUNT_INFO_KEY', 'Account-Info')
 
+# decoded account info / auth user cache, ACCOUNT_INFO_SHARED_CACHE is
+# an optional CACHES alias shared between workers
+ACCOUNT_INFO_CACHE_SIZE = int(os.getenv('ACCOUNT_INFO_CACHE_SIZE', 1024))
+ACCOUNT_INFO_CACHE_TTL = int(os.getenv('ACCOUNT_INFO_CACHE_TTL', 300))
+ACCOUNT_INFO_SHARED_CACHE = os.getenv('ACCOUNT_INFO_SHARED_CACHE', '')
+
+# background refresh of the OpenStack state of listed rows, at most once
+# per row every LIST_REFRESH_TTL seconds
+LIST_REFRESH_WORKERS = int(os.getenv('LIST_REFRESH_WORKERS', 8))
+LIST_REFRESH_TTL = int(os.getenv('LIST_REFRESH_TTL', 30))
+LIST_REFRESH_CACHE_SIZE = int(os.getenv('LIST_REFRESH_CACHE_SIZE', 10000))
+# refreshes waiting for a worker, the rows listed beyond are not queued
+LIST_REFRESH_MAX_PENDING = int(os.getenv('LIST_REFRESH_MAX_PENDING', 1000))
+# volume attach/detach lists skip the rows updated within the window
+VOLUME_STATUS_FRESHNESS = int(os.getenv('VOLUME_STATUS_FRESHNESS', 10))
+VOLUME_REFRESH_CONCURRENCY = int(os.getenv('VOLUME_REFRESH_CONCURRENCY', 8))
+# parallel cinder requests of a batch volume creation
+VOLUME_CREATE_CONCURRENCY = int(os.getenv('VOLUME_CREATE_CONCURRENCY', 8))
+VOLUME_CREATE_MAX_BATCH = int(os.getenv('VOLUME_CREATE_MAX_BATCH', 50))
+# asynchronous openstack jobs: concurrent jobs per operation, a job finding
+# all the slots taken is retried every JOB_SLOT_RETRY_DELAY seconds
+JOB_CONCURRENCY = {
+    'volume_attach': int(os.getenv('JOB_VOLUME_ATTACH_CONCURRENCY', 4)),
+    'volume_detach': int(os.getenv('JOB_VOLUME_DETACH_CONCURRENCY', 4)),
+    'volume_extend': int(os.getenv('JOB_VOLUME_EXTEND_CONCURRENCY', 2)),
+    'volume_delete': int(os.getenv('JOB_VOLUME_DELETE_CONCURRENCY', 4)),
+}
+JOB_SLOT_RETRY_DELAY = int(os.getenv('JOB_SLOT_RETRY_DELAY', 5))
+JOB_SLOT_MAX_RETRIES = int(os.getenv('JOB_SLOT_MAX_RETRIES', 120))
+JOB_WAIT_TIMEOUT = int(os.getenv('JOB_WAIT_TIMEOUT', 600))
+# a job recorded on a volume for longer is considered lost, the volume is
+# refreshed and accepts new jobs again
+JOB_MAX_AGE = int(os.getenv(
+    'JOB_MAX_AGE',
+    JOB_SLOT_MAX_RETRIES * JOB_SLOT_RETRY_DELAY + JOB_WAIT_TIMEOUT + 300))
+
 # RabbitMQ
 TRANSPORT_URL = os.getenv('TRANSPORT_URL', '')
 
+# seconds to coalesce the notifications of a resource into one sync task,
+# 0 sends a task per notification
+NOTIFICATION_COALESCE_WINDOW = float(os.getenv('NOTIFICATION_COALESCE_WINDOW', 2))
+# notification listener: oslo.messaging executor ('threading' or 'eventlet')
+# and its pool size, batches of NOTIFICATION_BATCH_SIZE (> 1) messages are
+# processed together and their tasks published at once
+NOTIFICATION_EXECUTOR = os.getenv('NOTIFICATION_EXECUTOR', 'threading')
+NOTIFICATION_POOL_SIZE = int(os.getenv('NOTIFICATION_POOL_SIZE', 64))
+NOTIFICATION_BATCH_SIZE = int(os.getenv('NOTIFICATION_BATCH_SIZE', 0))
+NOTIFICATION_BATCH_TIMEOUT = int(os.getenv('NOTIFICATION_BATCH_TIMEOUT', 1))
+# rabbit prefetch count, 0 keeps the oslo.messaging default
+NOTIFICATION_PREFETCH = int(os.getenv('NOTIFICATION_PREFETCH', 0))
+
 # UUM URL
 UUM_URL = os.getenv('UUM_URL', '')
 
@@ -276,6 +331,20 @@ CELERY_RESULT_BACKEND = 'django-db'
 # DJANGO_CELERY_BEAT_TZ_AWARE = False
 # CELERY_BEAT_SCHEDULER = 'django_celery_beat.schedulers:DatabaseScheduler'
 
+# OpenStack resources sync
+SYNC_BULK_CHUNK_SIZE = int(os.getenv('SYNC_BULK_CHUNK_SIZE', 500))
+SYNC_TENANT_CONCURRENCY = int(os.getenv('SYNC_TENANT_CONCURRENCY', 4))
+# flavor/image... lookup indexes used while converting resources
+SYNC_LOOKUP_TTL = int(os.getenv('SYNC_LOOKUP_TTL', 300))
+SYNC_LOOKUP_MISS_REFRESH = int(os.getenv('SYNC_LOOKUP_MISS_REFRESH', 30))
+# keypair indexes kept per worker, one per openstack user
+SYNC_LOOKUP_KEYPAIR_USERS = int(os.getenv('SYNC_LOOKUP_KEYPAIR_USERS', 256))
+# incremental sync (opt-in): only fetch resources changed since the last run,
+# with a full reconcile (which also removes deleted resources) every interval
+SYNC_INCREMENTAL = bool(int(os.getenv('SYNC_INCREMENTAL', 0)))
+SYNC_FULL_INTERVAL = int(os.getenv('SYNC_FULL_INTERVAL', 3600))
+SYNC_WATERMARK_SKEW = int(os.getenv('SYNC_WATERMARK_SKEW', 60))
+
 
 SWAGGER = bool(int(os.getenv('SWAGGER', 0)))
 
@@ -0,0 +1,148 @@
+from celery import shared_task
+from celery.exceptions import MaxRetriesExceededError
+from django.conf import settings
+from sync import osapi
+from .models import Volume
+from .serializers import VolumeSerializer
+from . import locks
+import logging
+import openstack
+
+
+logger = logging.getLogger(__package__)
+
+
+def _refresh_volume(instance, os_conn):
+    """Save the cinder state of the volume into its row."""
+    volume = instance.get_volume(os_conn)
+    attachments = volume.attachments or []
+    instance.status = volume.status
+    instance.size = volume.size
+    instance.cluster_name = volume.host
+    instance.attachments = attachments
+    if attachments:
+        instance.server_id = attachments[0].get('server_id')
+        instance.server_name = instance.get_server(os_conn, instance.server_id).name
+        instance.device = attachments[0].get('device')
+        instance.attach_status = 'attached'
+    else:
+        instance.server_id = None
+        instance.server_name = None
+        instance.device = None
+        instance.attach_status = 'detached'
+    instance.save()
+
+
+def _restore_volume(volume_id, os_conn):
+    """Replace the transient status of a failed job by the cinder state,
+    or by `error` when cinder cannot tell."""
+    try:
+        instance = Volume.objects.get(pk=volume_id)
+        _refresh_volume(instance, os_conn)
+    except Volume.DoesNotExist:
+        pass
+    except openstack.exceptions.NotFoundException:
+        logger.warning(f"openstack volume {volume_id} is gone, remove it")
+        Volume.objects.filter(pk=volume_id).delete()
+    except Exception as exc:
+        logger.warning(f"try refreshing openstack volume {volume_id}: {exc}")
+        Volume.objects.filter(pk=volume_id).update(status='error')
+
+
+def _finish_job(task, volume_id):
+    """Clear the job recorded on the volume by `start_job`."""
+    Volume.objects.filter(pk=volume_id, job_id=task.request.id).update(
+        job_id=None, job_operation=None, job_queued_at=None)
+
+
+def _wait_volume(instance, os_conn, action, done_fn):
+    """Poll the volume until `done_fn(volume)`, fail on an error status."""
+    for _ in openstack.utils.iterate_timeout(
+            settings.JOB_WAIT_TIMEOUT,
+            f"Timeout waiting for volume {instance.id} to be {action}", wait=2):
+        volume = instance.get_volume(os_conn)
+        if volume.status.startswith('error'):
+            raise openstack.exceptions.ResourceFailure(
+                f"volume {instance.id} {action} failed: {volume.status}")
+        if done_fn(volume):
+            return volume
+
+
+def _attached_to(volume, server_id):
+    return any(att.get('server_id') == server_id for att in volume.attachments or [])
+
+
+def _run_volume_job(task, operation, volume_id, job_fn):
+    """Run `job_fn(os_conn, instance)` within one of the concurrency slots of
+    `operation`, the job is retried later when they are all taken.
+
+    Jobs run with the service session, which re-authenticates by itself
+    however long they wait. On failure the row gets the cinder state back
+    before the error is raised into the task result.
+    """
+    os_conn = osapi.get_connection()
+    with locks.slot(operation, settings.JOB_CONCURRENCY[operation]) as slot:
+        if slot is None:
+            try:
+                raise task.retry(countdown=settings.JOB_SLOT_RETRY_DELAY)
+            except MaxRetriesExceededError:
+                logger.error(f"no free {operation} slot for volume {volume_id}, give up")
+                _restore_volume(volume_id, os_conn)
+                _finish_job(task, volume_id)
+                raise
+
+        try:
+            instance = Volume.objects.get(pk=volume_id)
+            return job_fn(os_conn, instance)
+        except Exception as exc:
+            logger.error(f"try {operation} openstack volume {volume_id}: {exc}")
+            _restore_volume(volume_id, os_conn)
+            raise
+        finally:
+            _finish_job(task, volume_id)
+
+
+@shared_task(bind=True, max_retries=settings.JOB_SLOT_MAX_RETRIES)
+def volume_attach(self, volume_id, server_id):
+    def job(os_conn, instance):
+        instance.attached_volume(os_conn, server_id)
+        _wait_volume(instance, os_conn, 'attached',
+                     lambda volume: volume.status == 'in-use' and _attached_to(volume, server_id))
+        _refresh_volume(instance, os_conn)
+        return VolumeSerializer(instance).data
+
+    return _run_volume_job(self, 'volume_attach', volume_id, job)
+
+
+@shared_task(bind=True, max_retries=settings.JOB_SLOT_MAX_RETRIES)
+def volume_detach(self, volume_id, server_id):
+    def job(os_conn, instance):
+        instance.detached_volume(os_conn, server_id)
+        _wait_volume(instance, os_conn, 'detached',
+                     lambda volume: volume.status != 'detaching' and not _attached_to(volume, server_id))
+        _refresh_volume(instance, os_conn)
+        return VolumeSerializer(instance).data
+
+    return _run_volume_job(self, 'volume_detach', volume_id, job)
+
+
+@shared_task(bind=True, max_retries=settings.JOB_SLOT_MAX_RETRIES)
+def volume_extend(self, volume_id, size):
+    def job(os_conn, instance):
+        instance.extend_volume(os_conn, new_size=size)
+        _wait_volume(instance, os_conn, 'extended',
+                     lambda volume: volume.size == size and volume.status != 'extending')
+        _refresh_volume(instance, os_conn)
+        return VolumeSerializer(instance).data
+
+    return _run_volume_job(self, 'volume_extend', volume_id, job)
+
+
+@shared_task(bind=True, max_retries=settings.JOB_SLOT_MAX_RETRIES)
+def volume_delete(self, volume_id):
+    def job(os_conn, instance):
+        instance.destroy_volume(os_conn)
+        instance.delete()
+        return {'id': volume_id}
+
+    return _run_volume_job(self, 'volume_delete', volume_id, job)
@@ -0,0 +1,217 @@
+import threading
+import time
+import uuid
+from datetime import timedelta
+from unittest import mock
+
+from django.test import SimpleTestCase
+from django.test import TestCase
+from django.test import override_settings
+from django.utils import timezone
+from keystoneauth1 import exceptions as ks_exc
+from rest_framework.test import APIRequestFactory
+
+from djapp import models
+from djapp import refresh
+from djapp import views
+from djapp.cache import LRUCache
+
+
+class _Stub(object):
+    def __init__(self, **attrs):
+        self.__dict__.update(attrs)
+
+
+def _volume_conn(volumes, calls=None):
+    """Connection stub serving the cinder volumes of `volumes` by id."""
+    calls = calls if calls is not None else []
+
+    def get_volume(volume_id):
+        calls.append(str(volume_id))
+        return volumes[str(volume_id)]
+
+    def get_server(server_id):
+        calls.append(('server', server_id))
+        return _Stub(name='server-%s' % server_id[:4])
+
+    return _Stub(volume=_Stub(get_volume=get_volume),
+                 compute=_Stub(get_server=get_server))
+
+
+def _cinder_volume(status, attachments=()):
+    return _Stub(status=status, size=1, name='v', description=None,
+                 host='control@lvm-1#lvm-1', attachments=list(attachments))
+
+
+def _viewset(os_conn):
+    viewset = views.VolumeViewSet()
+    viewset.request = _Stub(os_conn=os_conn)
+    return viewset
+
+
+class VolumeJobTestCase(TestCase):
+
+    def setUp(self):
+        self.volume = models.Volume.objects.create(
+            id=uuid.uuid4(), name='v', status='available', size=1)
+        self.task = mock.Mock()
+        self.task.name = 'djapp.tasks.volume_attach'
+
+    def test_second_job_conflicts(self):
+        viewset = _viewset(None)
+        response = viewset.start_job(self.task, self.volume, 'attaching', 's1')
+        self.assertEqual(response.status_code, 202)
+        self.volume.refresh_from_db()
+        self.assertEqual(self.volume.status, 'attaching')
+        self.assertEqual(self.volume.job_id, response.data['task_id'])
+        self.assertEqual(self.volume.job_operation, 'volume_attach')
+
+        with mock.patch.object(views, 'AsyncResult') as result:
+            result.return_value.ready.return_value = False
+            response = viewset.start_job(self.task, self.volume, 'attaching', 's1')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(self.task.apply_async.call_count, 1)
+
+    def test_publish_failure_reverts(self):
+        self.task.apply_async.side_effect = OSError('broker down')
+        response = _viewset(None).start_job(self.task, self.volume, 'attaching', 's1')
+        self.assertEqual(response.status_code, 503)
+        self.volume.refresh_from_db()
+        self.assertEqual(self.volume.status, 'available')
+        self.assertIsNone(self.volume.job_id)
+
+    def test_refresh_keeps_job_status(self):
+        models.Volume.objects.filter(pk=self.volume.pk).update(
+            status='attaching', job_id='j1', job_operation='volume_attach',
+            job_queued_at=timezone.now())
+        calls = []
+        conn = _volume_conn({str(self.volume.pk): _cinder_volume('available')}, calls)
+        _viewset(conn).refresh_page(list(models.Volume.objects.all()))
+        self.assertEqual(calls, [])
+        self.assertEqual(models.Volume.objects.get(pk=self.volume.pk).status, 'attaching')
+
+    def test_refresh_lost_job(self):
+        models.Volume.objects.filter(pk=self.volume.pk).update(
+            status='attaching', job_id='j1', job_operation='volume_attach',
+            job_queued_at=timezone.now() - timedelta(days=1))
+        conn = _volume_conn({str(self.volume.pk): _cinder_volume('available')})
+        _viewset(conn).refresh_page(list(models.Volume.objects.all()))
+        self.assertEqual(models.Volume.objects.get(pk=self.volume.pk).status, 'available')
+
+
+class VolumeCreateTestCase(TestCase):
+
+    def test_connect_failure_is_per_volume(self):
+        calls = []
+
+        def create_volume(**kwargs):
+            calls.append(kwargs)
+            if len(calls) == 2:
+                raise ks_exc.ConnectFailure('connection refused')
+            return _Stub(id=uuid.uuid4(), **kwargs)
+
+        conn = _Stub(volume=_Stub(create_volume=create_volume))
+        results = models.Volume.create_volumes(conn, 3, size=1, name='v')
+        self.assertEqual([volume is not None for volume, _ in results],
+                         [True, False, True])
+        self.assertIsInstance(results[1][1], ks_exc.ConnectFailure)
+
+    def test_missing_num(self):
+        view = views.VolumeViewSet.as_view(
+            {'post': 'create'}, authentication_classes=(), permission_classes=())
+        request = APIRequestFactory().post(
+            '/volumes/', {'name': 'v', 'size': 1, 'volume_type': 'ssd'},
+            format='json')
+        response = view(request)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('num', response.data['detail'])
+
+
+def _wait_refreshes():
+    for _ in range(200):
+        if not refresh._pending:
+            return
+        time.sleep(0.01)
+    raise AssertionError("refreshes still pending")
+
+
+class RefreshScheduleTestCase(SimpleTestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(refresh, '_refreshed', LRUCache(maxsize=100, ttl=60))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.rows = [_Stub(pk=pk) for pk in range(3)]
+
+    def test_pending_rows_queued_once(self):
+        gate, done = threading.Event(), []
+
+        def slow(row):
+            gate.wait(5)
+            done.append(row.pk)
+
+        self.assertEqual(refresh.schedule('image', self.rows, slow), 3)
+        self.assertEqual(refresh.schedule('image', self.rows, slow), 0)
+        gate.set()
+        _wait_refreshes()
+        self.assertEqual(sorted(done), [0, 1, 2])
+        # fresh for LIST_REFRESH_TTL
+        self.assertEqual(refresh.schedule('image', self.rows, slow), 0)
+
+    def test_fresh_rows_expire(self):
+        refresh._refreshed.ttl = 0.01
+        refresh.schedule('image', self.rows, lambda row: None)
+        _wait_refreshes()
+        time.sleep(0.02)
+        self.assertEqual(refresh.schedule('image', self.rows, lambda row: None), 3)
+        _wait_refreshes()
+
+    def test_failed_refresh_not_fresh(self):
+        def fail(row):
+            raise OSError('cinder down')
+
+        refresh.schedule('image', self.rows, fail)
+        _wait_refreshes()
+        self.assertEqual(refresh.schedule('image', self.rows, lambda row: None), 3)
+        _wait_refreshes()
+
+    @override_settings(LIST_REFRESH_MAX_PENDING=2)
+    def test_queue_bounded(self):
+        gate = threading.Event()
+        self.assertEqual(refresh.schedule('image', self.rows, lambda row: gate.wait(5)), 2)
+        gate.set()
+        _wait_refreshes()
+
+
+class VolumeRefreshTestCase(TestCase):
+
+    def test_attach_fields_refreshed(self):
+        old = timezone.now() - timedelta(minutes=5)
+        server_id = str(uuid.uuid4())
+        attached, unchanged = (
+            models.Volume.objects.create(id=uuid.uuid4(), name=name, status='available', size=1)
+            for name in ('attached', 'unchanged'))
+        models.Volume.objects.update(updated_at=old)
+        calls = []
+        conn = _volume_conn({
+            str(attached.pk): _cinder_volume('in-use', [
+                {'server_id': server_id, 'device': '/dev/vdb'}]),
+            str(unchanged.pk): _cinder_volume('available'),
+        }, calls)
+
+        _viewset(conn).refresh_page(list(models.Volume.objects.all()))
+
+        attached.refresh_from_db()
+        self.assertEqual((attached.status, str(attached.server_id), attached.server_name,
+                          attached.device, attached.attach_status),
+                         ('in-use', server_id, 'server-%s' % server_id[:4],
+                          '/dev/vdb', 'attached'))
+        unchanged.refresh_from_db()
+        self.assertGreater(unchanged.updated_at, old)
+
+        # the next refresh keeps the name of the same server
+        calls.clear()
+        models.Volume.objects.update(updated_at=old)
+        _viewset(conn).refresh_page(list(models.Volume.objects.all()))
+        self.assertNotIn(('server', server_id), calls)
+        self.assertEqual(len(calls), 2)
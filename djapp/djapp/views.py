@@ -1,4 +1,11 @@
+from celery.result import AsyncResult
+from celery.utils import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from django.conf import settings
+from django.db import DatabaseError
 from django.db.models import Q
+from django.utils import timezone
 from django_filters.rest_framework import DjangoFilterBackend
 from drf_yasg.utils import swagger_auto_schema
 from rest_framework import mixins, viewsets, status
@@ -18,6 +25,8 @@ from .serializers import (
     VolumeSerializer, UpdateVolumeSerializer,
     VolumeTypeSerializer,
 )
+from . import refresh
+from . import tasks
 from .filters import (
     NetworkFilter, PortFilter,
     FirewallFilter, SimpleSourceTenantNetworkFilter, SimpleDestinationTenantNetworkFilter,
@@ -555,22 +564,26 @@ class ImageViewSet(OSCommonModelMixin, viewsets.ModelViewSet):
         queryset = self.filter_queryset(self.get_queryset())
         page = self.paginate_queryset(queryset)
         if page is not None:
-            for instance in page:
-                image = instance.get_image(request.os_conn)
-                if instance.size == image.size and instance.status == image.status:
-                    continue
-                serializer = ImageSerializer(instance, data=image)
-                serializer.is_valid(raise_exception=True)
-                serializer.save(
-                    status=image.status,
-                    updated_at=image.updated_at,
-                    size=image.size
-                )
+            # served from db, stale rows are refreshed from glance in background
+            os_conn = request.os_conn
+            refresh.schedule('image', page,
+                             lambda instance: self._refresh_image(instance, os_conn))
             serializer = self.get_serializer(page, many=True)
             return self.get_paginated_response(serializer.data)
         serializer = self.get_serializer(queryset, many=True)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
+    @staticmethod
+    def _refresh_image(instance, os_conn):
+        image = instance.get_image(os_conn)
+        if instance.size == image.size and instance.status == image.status:
+            return
+        Image.objects.filter(pk=instance.pk).update(
+            status=image.status,
+            updated_at=image.updated_at,
+            size=image.size
+        )
+
     def create(self, request, *args, **kwargs):
         file = request.data['file']
         dis_for = request.data['disk_format']
@@ -720,59 +733,118 @@ class VolumeViewSet(OSCommonModelMixin, viewsets.ModelViewSet):
 
     def create(self, request, *args, **kwargs):
         data_request = request.data.copy()
-        data_request.pop('num')
+        data_request.pop('num', None)
         serializer = self.get_serializer(data=data_request)
         serializer.is_valid(raise_exception=True)
         data = serializer.validated_data
-        return_data = []
-
         try:
-            for num in range(int(request.data['num'])):
-                volume = Volume.create_volume(
-                    request.os_conn,
-                    name=data['name'],
-                    size=data['size'],
-                    volume_type=data['volume_type'])
-                serializer = self.get_serializer(data=data_request)
-                serializer.is_valid(raise_exception=True)
-                serializer.save(
-                    id=volume.id,
-                    name=volume.name,
-                    description=volume.description,
-                    project_id=volume.location.project.id,
-                    user_id=request.user.id,
-                    is_bootable=volume.is_bootable,
-                    volume_type=volume.volume_type,
-                    status=volume.status,
-                    attachments=volume.attachments,
-                    cluster_name=volume.host,
-                    user_name=request.user,
-                    tenant_id=request.account_info.get('tenantId'),
-                    tenant_name=request.account_info.get('tenantName'),
-                )
-                return_data.append(serializer.data)
-
-        except openstack.exceptions.HttpException as exc:
-            logger.error(f"try create openstack volume {data['name']}:{exc}")
+            num = int(request.data.get('num'))
+        except (TypeError, ValueError):
+            num = 0
+        if not 1 <= num <= settings.VOLUME_CREATE_MAX_BATCH:
             return Response({
-                "detail": f"{exc}"
+                "detail": f"num must be between 1 and {settings.VOLUME_CREATE_MAX_BATCH}"
             }, status=status.HTTP_400_BAD_REQUEST)
-        else:
-            headers = self.get_success_headers(serializer.data)
-            return Response(return_data, status=status.HTTP_201_CREATED, headers=headers)
 
-    def destroy(self, request, *args, **kwargs):
-        instance = self.get_object()
+        created = Volume.create_volumes(
+            request.os_conn, num,
+            size=data['size'],
+            name=data['name'],
+            volume_type=data['volume_type'],
+            concurrency=settings.VOLUME_CREATE_CONCURRENCY)
+
+        # one result per requested volume, rows saved at once
+        rows, results = [], []
+        for volume, exc in created:
+            if exc is not None:
+                logger.error(f"try create openstack volume {data['name']}:{exc}")
+                results.append({'status': 'failed', 'detail': f"{exc}"})
+                continue
+            row = Volume(**{
+                **data,
+                'id': volume.id,
+                'name': volume.name,
+                'description': volume.description,
+                'project_id': volume.location.project.id,
+                'user_id': request.user.id,
+                'is_bootable': volume.is_bootable,
+                'volume_type': volume.volume_type,
+                'status': volume.status,
+                'attachments': volume.attachments,
+                'cluster_name': volume.host,
+                'user_name': request.user.username,
+                'tenant_id': request.account_info.get('tenantId'),
+                'tenant_name': request.account_info.get('tenantName'),
+            })
+            rows.append(row)
+            results.append({'status': 'created', 'volume': row})
+        # the volume sync may have recorded some of them already
+        db_error = None
         try:
-            instance.destroy_volume(request.os_conn)
-        except openstack.exceptions.HttpException as exc:
-            logger.error(f"try destroying openstack volume {instance.name}:{exc}")
+            Volume.objects.bulk_create(rows, ignore_conflicts=True)
+        except DatabaseError as exc:
+            logger.error(f"try recording created openstack volumes {data['name']}:{exc}")
+            db_error = f"created but not recorded: {exc}"
+
+        for result in results:
+            if 'volume' in result:
+                result['volume'] = self.get_serializer(result['volume']).data
+                if db_error:
+                    result['detail'] = db_error
+        if not rows:
+            return Response(results, status=status.HTTP_400_BAD_REQUEST)
+        if len(rows) < num or db_error:
+            return Response(results, status=status.HTTP_207_MULTI_STATUS)
+        return Response(results, status=status.HTTP_201_CREATED)
+
+    @staticmethod
+    def _job_recent(instance, now):
+        """Whether a job recorded on the volume may still be queued or
+        running, older ones are considered lost."""
+        return bool(instance.job_id and instance.job_queued_at and
+                    instance.job_queued_at > now - timedelta(seconds=settings.JOB_MAX_AGE))
+
+    def _job_pending(self, instance):
+        return (self._job_recent(instance, timezone.now()) and
+                not AsyncResult(instance.job_id).ready())
+
+    def start_job(self, task, instance, job_status, *args):
+        """Mark the volume with the transient `job_status` and run `task` in
+        celery, its progress is polled with the returned task id.
+
+        The job is recorded on the volume until it ends: the list refresh
+        keeps the transient status meanwhile, and no other job is started.
+        Jobs run with the service credentials, the caller access to the
+        volume (and server) must be checked before."""
+        if self._job_pending(instance):
+            return Response({
+                "detail": f"volume {instance.name} has a {instance.job_operation} job in progress",
+                "task_id": instance.job_id
+            }, status=status.HTTP_409_CONFLICT)
+
+        job_id = uuid()
+        # compare and set: a concurrent request may have started a job
+        claimed = Volume.objects.filter(pk=instance.pk, job_id=instance.job_id).update(
+            status=job_status, job_id=job_id,
+            job_operation=task.name.rsplit('.', 1)[-1], job_queued_at=timezone.now())
+        if not claimed:
+            return Response({
+                "detail": f"volume {instance.name} has a job in progress"
+            }, status=status.HTTP_409_CONFLICT)
+        try:
+            task.apply_async((str(instance.id),) + args, task_id=job_id)
+        except Exception as exc:
+            Volume.objects.filter(pk=instance.pk, job_id=job_id).update(
+                status=instance.status, job_id=None, job_operation=None, job_queued_at=None)
+            logger.error(f"try queueing {task.name} of volume {instance.name}: {exc}")
             return Response({
                 "detail": f"{exc}"
-            }, status=status.HTTP_400_BAD_REQUEST)
-        else:
-            self.perform_destroy(instance)
-            return Response({"detail": "删除成功"}, status=status.HTTP_204_NO_CONTENT)
+            }, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        return Response({'task_id': job_id}, status=status.HTTP_202_ACCEPTED)
+
+    def destroy(self, request, *args, **kwargs):
+        instance = self.get_object()
+        return self.start_job(tasks.volume_delete, instance, 'deleting')
 
     def update(self, request, *args, **kwargs):
         instance = self.get_object()
@@ -868,50 +940,27 @@ class VolumeViewSet(OSCommonModelMixin, viewsets.ModelViewSet):
         serializer.is_valid(raise_exception=True)
         data = serializer.validated_data
         try:
-            instance.attached_volume(request.os_conn, data['server_id'])
+            # the server must be visible with the caller token
+            instance.get_server(request.os_conn, data['server_id'])
         except openstack.exceptions.HttpException as exc:
             logger.error(f"try attached openstack volume {instance.name}:{exc}")
             return Response({
                 "detail": f"{exc}"
             }, status=status.HTTP_400_BAD_REQUEST)
-        else:
-            volume = instance.get_volume(request.os_conn)
-            server = instance.get_server(request.os_conn, data['server_id'])
-            serializer = VolumeSerializer(instance, data=volume)
-            serializer.is_valid(raise_exception=True)
-            serializer.save(
-                status="attaching",
-                server_name=server.name,
-                server_id=data['server_id'],
-            )
-            serializer = self.get_serializer(instance)
-            return Response(serializer.data, status=status.HTTP_201_CREATED)
+        return self.start_job(tasks.volume_attach, instance, 'attaching',
+                              str(data['server_id']))
 
     @action(detail=True, methods=['post'])
     def detached(self, request, *args, **kwargs):
         instance = self.get_object()
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
-        try:
-            instance.detached_volume(request.os_conn, instance.server_id)
-        except openstack.exceptions.BadRequestException as exc:
-            logger.error(f"try detached openstack volume {instance.name}:{exc}")
+        if instance.server_id is None:
             return Response({
-                "detail": f"{exc}"
+                "detail": f"volume {instance.name} is not attached"
             }, status=status.HTTP_400_BAD_REQUEST)
-        else:
-            volume = instance.get_volume(request.os_conn)
-            serializer = VolumeSerializer(instance, data=volume)
-            serializer.is_valid(raise_exception=True)
-            serializer.save(
-                status="detaching",
-                attachments=volume.attachments,
-                device=None,
-                server_name=None,
-                server_id=None,
-            )
-            serializer = self.get_serializer(instance)
-            return Response(serializer.data, status=status.HTTP_201_CREATED)
+        return self.start_job(tasks.volume_detach, instance, 'detaching',
+                              str(instance.server_id))
 
     @action(detail=True, methods=['post'])
     def extend(self, request, *args, **kwargs):
@@ -919,39 +968,95 @@ class VolumeViewSet(OSCommonModelMixin, viewsets.ModelViewSet):
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
         data = serializer.validated_data
-
+        return self.start_job(tasks.volume_extend, instance, 'extending',
+                              data['size'])
+
+    # transient statuses are refreshed whatever the freshness window
+    TRANSIENT_STATUSES = ('creating', 'attaching', 'detaching', 'extending',
+                          'deleting', 'reserved', 'downloading', 'uploading')
+
+    def _is_stale(self, instance, fresh_after, now):
+        # the job sets the cinder state of the volume once it ends
+        if self._job_recent(instance, now):
+            return False
+        return (instance.updated_at is None or instance.updated_at < fresh_after
+                or instance.status in self.TRANSIENT_STATUSES)
+
+    @staticmethod
+    def _attachment(volume):
+        attachments = volume.attachments or []
+        return attachments[0] if attachments else {}
+
+    @classmethod
+    def _fetch_volume(cls, instance, os_conn):
+        """Fetch the cinder volume and the name of the server it is attached
+        to, the stored name is kept while that server is unchanged."""
         try:
-            instance.extend_volume(request.os_conn, new_size=data['size'])
+            volume = instance.get_volume(os_conn)
         except openstack.exceptions.HttpException as exc:
-            logger.error(f"try detached openstack volume {instance.name}:{exc}")
-            return Response({
-                "detail": f"{exc}"
-            }, status=status.HTTP_400_BAD_REQUEST)
-        else:
-            volume = instance.get_volume(request.os_conn)
-            serializer = VolumeSerializer(instance, data=volume)
-            serializer.is_valid(raise_exception=True)
-            serializer.save(
-                status=volume.status,
-                size=data['size'],
-            )
-            serializer = self.get_serializer(instance)
-            return Response(serializer.data, status=status.HTTP_201_CREATED)
+            logger.warning(f"try refreshing openstack volume {instance.id}: {exc}")
+            return None, None
+        server_id = cls._attachment(volume).get('server_id')
+        if server_id is None:
+            return volume, None
+        if instance.server_id and str(instance.server_id) == server_id:
+            return volume, instance.server_name
+        try:
+            return volume, instance.get_server(os_conn, server_id).name
+        except openstack.exceptions.HttpException as exc:
+            logger.warning(f"try getting openstack server {server_id}: {exc}")
+            return volume, None
+
+    def refresh_page(self, page):
+        """Refresh the status of the page volumes not updated within
+        VOLUME_STATUS_FRESHNESS seconds, fetched concurrently from Cinder."""
+        now = timezone.now()
+        fresh_after = now - timedelta(seconds=settings.VOLUME_STATUS_FRESHNESS)
+        stale = [instance for instance in page if self._is_stale(instance, fresh_after, now)]
+        if not stale:
+            return
+        os_conn = self.request.os_conn
+        workers = min(len(stale), settings.VOLUME_REFRESH_CONCURRENCY)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(lambda instance: self._fetch_volume(instance, os_conn), stale))
+
+        changed, checked = [], []
+        for instance, (volume, server_name) in zip(stale, results):
+            if volume is None:
+                continue
+            instance.updated_at = now
+            attachment = self._attachment(volume)
+            server_id = attachment.get('server_id')
+            if (instance.status == volume.status and
+                    (str(instance.server_id) if instance.server_id else None) == server_id):
+                checked.append(instance.pk)
+                continue
+            instance.status = volume.status
+            instance.size = volume.size
+            instance.name = volume.name
+            instance.description = volume.description
+            instance.cluster_name = volume.host
+            instance.attachments = volume.attachments or []
+            # attach fields of the first attachment, as the sync sets them
+            instance.server_id = server_id
+            instance.server_name = server_name
+            instance.device = attachment.get('device')
+            instance.attach_status = 'attached' if server_id else 'detached'
+            changed.append(instance)
+        if changed:
+            Volume.objects.bulk_update(changed, [
+                'status', 'size', 'name', 'description', 'cluster_name',
+                'attachments', 'server_id', 'server_name', 'device',
+                'attach_status', 'updated_at'])
+        if checked:
+            # unchanged rows are fresh for the next polls too
+            Volume.objects.filter(pk__in=checked).update(updated_at=now)
 
     def list_page(self, qs):
         queryset = self.filter_queryset(qs)
         page = self.paginate_queryset(queryset)
         if page is not None:
-            for instance in page:
-                volume = instance.get_volume(self.request.os_conn)
-                if instance.status == volume.status:
-                    continue
-                serializer = UpdateVolumeSerializer(instance, data=volume)
-                serializer.is_valid(raise_exception=True)
-                serializer.save(
-                    cluster_name=volume.host,
-                    attachments=volume.attachments,
-                )
+            self.refresh_page(page)
             serializer = self.get_serializer(page, many=True)
             return serializer
         serializer = self.get_serializer(queryset, many=True)
@@ -0,0 +1,103 @@
+import logging
+import time
+import uuid
+
+from django.core.management.base import BaseCommand, CommandError
+
+from djapp import models
+from sync import osapi
+from sync.tasks import base
+
+
+LOG_FORMAT = "%(asctime)s %(levelname)s %(module)s.%(funcName)s: %(message)s"
+logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
+
+LOG = logging.getLogger(__name__)
+
+
+def _make_objects(size, churn):
+    """Synthetic flavor rows and os dicts, `churn` of them only exist on
+    one side and as many are renamed."""
+    shift = int(size * churn)
+    keys = [str(uuid.UUID(int=i)) for i in range(size + shift)]
+    db_objects = [models.Flavor(id=key, name=key) for key in keys[:size]]
+    os_objects = [{'id': key, 'name': 'renamed' if i < shift else key}
+                  for i, key in enumerate(keys[shift:])]
+    return db_objects, os_objects
+
+
+def _convert_flavor(db_obj, os_obj):
+    db_obj.id = os_obj['id']
+    db_obj.name = os_obj['name']
+
+
+def _diff(db_objects, os_objects):
+    return base.diff_keys({str(obj.pk): obj for obj in db_objects},
+                          {obj['id']: obj for obj in os_objects})
+
+
+def _plan(db_objects, os_objects):
+    return base.plan_sync(models.Flavor, db_objects, lambda obj: str(obj.pk),
+                          os_objects, lambda obj: obj['id'], _convert_flavor)
+
+
+def _plan_pages(db_objects, os_objects, page_size):
+    """The plans of `alg_stream_sync`, one per page with the rows of its
+    keys, then the removal of the unseen rows."""
+    rows = {str(obj.pk): obj for obj in db_objects}
+    seen = set()
+    for i in range(0, len(os_objects), page_size):
+        page = os_objects[i:i + page_size]
+        keys = [os_obj['id'] for os_obj in page]
+        seen.update(keys)
+        _plan([rows[key] for key in keys if key in rows], page)
+    _plan([obj for key, obj in rows.items() if key not in seen], [])
+
+
+def _best(repeat, make_fn, run_fn):
+    """Best time of `run_fn` over fresh objects, conversions modify them."""
+    cost = float('inf')
+    for _ in range(repeat):
+        objects = make_fn()
+        start = time.perf_counter()
+        run_fn(*objects)
+        cost = min(cost, time.perf_counter() - start)
+    return cost
+
+
+class Command(BaseCommand):
+    help = "Benchmark the resource sync diff and plan with synthetic objects"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', nargs='+', type=int,
+                            default=[1000, 10000, 100000])
+        parser.add_argument('--churn', type=float, default=0.1,
+                            help="ratio of added/removed/updated objects")
+        parser.add_argument('--page-size', type=int,
+                            default=osapi.PAGE_SIZE)
+        parser.add_argument('--repeat', type=int, default=3)
+        parser.add_argument('--max-seconds', type=float, default=None,
+                            help="fail when a plan takes longer than this")
+
+    def handle(self, *args, **kwargs):
+        # per object logs would dominate the timings
+        logging.getLogger(base.__name__).setLevel(logging.WARNING)
+
+        for size in kwargs['sizes']:
+            def make():
+                return _make_objects(size, kwargs['churn'])
+
+            diff_cost = _best(kwargs['repeat'], make, _diff)
+            bulk_cost = _best(kwargs['repeat'], make, _plan)
+            stream_cost = _best(kwargs['repeat'], make, lambda db, os: _plan_pages(
+                db, os, kwargs['page_size']))
+
+            self.stdout.write("size: %8d  diff: %.4fs  bulk plan: %.4fs  "
+                              "stream plan: %.4fs"
+                              % (size, diff_cost, bulk_cost, stream_cost))
+
+            max_seconds = kwargs['max_seconds']
+            plan_cost = max(bulk_cost, stream_cost)
+            if max_seconds is not None and plan_cost > max_seconds:
+                raise CommandError("plan of %s objects took %.4fs > %.4fs"
+                                   % (size, plan_cost, max_seconds))
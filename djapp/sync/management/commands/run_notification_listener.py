@@ -1,4 +1,5 @@
 import logging
+import threading
 
 from django.core.management.base import BaseCommand
 
@@ -14,7 +15,30 @@ LOG = logging.getLogger(__name__)
 class Command(BaseCommand):
     help = "Waiting to receiving notifications and process"
 
+    def add_arguments(self, parser):
+        parser.add_argument('--stats-interval', type=int, default=60,
+                            help='Seconds between throughput/latency stats '
+                                 'prints, 0 disables them')
+
+    def _print_stats(self, notification_listener, interval, stopped):
+        while not stopped.wait(interval):
+            stats = notification_listener.stats()
+            self.stdout.write("Listener: %(listener)s, dispatcher: %(dispatcher)s"
+                              % stats)
+            self.stdout.flush()
+
     def handle(self, *args, **kwargs):
         LOG.info("Server starting ...")
+        notification_listener = listener.NotificationListener()
+
+        stopped = threading.Event()
+        interval = kwargs['stats_interval']
+        if interval > 0:
+            threading.Thread(target=self._print_stats,
+                             args=(notification_listener, interval, stopped),
+                             daemon=True).start()
         # waiting to receive notifications and process
-        listener.start_listen()
+        try:
+            notification_listener.run()
+        finally:
+            stopped.set()
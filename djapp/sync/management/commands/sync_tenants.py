@@ -14,6 +14,11 @@ LOG = logging.getLogger(__name__)
 class Command(BaseCommand):
     help = "Sync Tenants' resources from OpenStack"
 
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true',
+                            help='Full sync instead of the changes since '
+                                 'the last run')
+
     def handle(self, *args, **kwargs):
         LOG.info("Start to Sync Tenants' resources from OpenStack ...")
-        user_tasks.do_tenants_sync()
+        user_tasks.do_tenants_sync(full=kwargs['full'])
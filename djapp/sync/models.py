@@ -1,5 +1,8 @@
 
-from django.db import models
+from django.db import models, transaction
+from django.utils import timezone
+
+from sync import stats
 
 
 class Project(models.Model):
@@ -153,3 +156,90 @@ class User(models.Model):
         if to_dict:
             return [u.to_dict() for u in users]
         return users
+
+
+class SyncWatermark(models.Model):
+    """High-water mark of the incremental syncs of a resource type.
+
+    `project_id` is empty for global resources (images, networks).
+    """
+    resource = models.CharField(
+        max_length=64)
+    project_id = models.CharField(
+        max_length=255,
+        default='',
+        blank=True)
+    changed_since = models.DateTimeField(
+        null=True)
+    full_synced_at = models.DateTimeField(
+        null=True)
+    updated_at = models.DateTimeField(
+        auto_now=True)
+
+    class Meta:
+        unique_together = ('resource', 'project_id')
+
+
+class SyncRun(models.Model):
+    """Ledger of a full `do_all_sync` run.
+
+    The admin and tenants phases run as separate tasks and merge their
+    counters when done, the last one finishes the run.
+    """
+    STATUS_RUNNING = 'running'
+    STATUS_SUCCESS = 'success'
+    STATUS_FAILED = 'failed'
+
+    task_id = models.CharField(
+        max_length=255,
+        null=True)
+    full = models.BooleanField(
+        default=False)
+    status = models.CharField(
+        max_length=16,
+        default=STATUS_RUNNING)
+    # phases not finished yet
+    pending = models.JSONField(
+        default=list)
+    started_at = models.DateTimeField(
+        auto_now_add=True)
+    finished_at = models.DateTimeField(
+        null=True)
+    duration = models.FloatField(
+        null=True)
+    errors = models.IntegerField(
+        default=0)
+    # 'GET servers' -> count/errors/seconds/max/latency histogram
+    api_calls = models.JSONField(
+        default=dict)
+    # model name -> created/updated/unchanged/removed/skipped/errors
+    rows = models.JSONField(
+        default=dict)
+    # phase -> count/errors/seconds
+    phases = models.JSONField(
+        default=dict)
+
+    class Meta:
+        ordering = ('-started_at',)
+
+    @classmethod
+    def finish_phase(cls, run_id, phase, run_stats):
+        """Merge the counters of a finished phase into the run."""
+        with transaction.atomic():
+            run = cls.objects.select_for_update().filter(pk=run_id).first()
+            if not run:
+                return None
+            counters = run_stats.to_dict()
+            stats.merge(run.api_calls, counters['api_calls'])
+            stats.merge(run.rows, counters['rows'])
+            stats.merge(run.phases, counters['phases'])
+            run.errors += run_stats.error_count()
+            run.pending = [name for name in run.pending if name != phase]
+            if not run.pending:
+                run.finished_at = timezone.now()
+                run.duration = round(
+                    (run.finished_at - run.started_at).total_seconds(), 3)
+                run.status = (cls.STATUS_FAILED if run.errors
+                              else cls.STATUS_SUCCESS)
+            run.save()
+            return run
@@ -0,0 +1,169 @@
+
+import contextlib
+import logging
+import threading
+import time
+
+from celery import group
+
+LOG = logging.getLogger(__name__)
+
+
+KIND_APPLY = 'apply'
+KIND_UPDATE = 'update'
+KIND_CREATE = 'create'
+KIND_DELETE = 'delete'
+
+# the strongest task of a window wins: a delete makes the create/update
+# useless, a create syncs the latest state anyway. An update fetches the
+# whole resource while an apply only carries its payload fields, so a
+# pending update is never replaced by an apply.
+KIND_PRIORITY = {
+    KIND_APPLY: -1,
+    KIND_UPDATE: 0,
+    KIND_CREATE: 1,
+    KIND_DELETE: 2,
+}
+
+STATS_LOG_INTERVAL = 60
+
+
+class CoalescingDispatcher(object):
+    """Coalesce the sync tasks of a resource over a short window.
+
+    The first notification of a resource opens a `window` seconds buffer,
+    the following ones only keep the strongest task, which is sent once
+    when the window closes. A zero window sends every task right away.
+    """
+
+    def __init__(self, window=0):
+        self.window = window
+        self._pending = {}
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopped = False
+        self._local = threading.local()
+        self.received = 0
+        self.dispatched = 0
+        self.errors = 0
+
+    def start(self):
+        if self.window <= 0 or self._thread:
+            return
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run,
+                                        name='notification-dispatcher',
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the flusher thread and send the pending tasks."""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        self._flush(force=True)
+        LOG.info("Notification dispatcher stopped: %s" % self.stats())
+
+    def submit(self, resource, resource_id, kind, task, *args):
+        """Schedule `task.delay(resource_id, *args)` for the resource window.
+
+        A task of the same kind replaces the pending one, so the latest
+        notification payload wins.
+        """
+        with self._cond:
+            self.received += 1
+            coalesce = self._thread is not None
+            if coalesce:
+                key = (resource, resource_id)
+                entry = self._pending.get(key)
+                if entry is None:
+                    self._pending[key] = [time.monotonic() + self.window,
+                                          kind, task, args]
+                    self._cond.notify()
+                elif KIND_PRIORITY[kind] >= KIND_PRIORITY[entry[1]]:
+                    entry[1:] = [kind, task, args]
+        if coalesce:
+            return
+        batch = getattr(self._local, 'batch', None)
+        if batch is not None:
+            batch.append((resource, resource_id, kind, task, args))
+        else:
+            self._publish([(resource, resource_id, kind, task, args)])
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Publish the tasks submitted by the block together, unless they
+        are coalesced."""
+        self._local.batch = []
+        try:
+            yield
+        finally:
+            batch, self._local.batch = self._local.batch, None
+            if batch:
+                self._publish(batch)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'received': self.received,
+                'dispatched': self.dispatched,
+                'pending': len(self._pending),
+                'errors': self.errors,
+            }
+
+    def _publish(self, entries):
+        """Send tasks, several ones as one group on a single producer."""
+        for resource, resource_id, kind, task, _ in entries:
+            LOG.info("%s %s: %s by %s" % (kind.capitalize(), resource,
+                                          resource_id, task.name))
+        try:
+            if len(entries) == 1:
+                _, resource_id, _, task, args = entries[0]
+                task.delay(resource_id, *args)
+            else:
+                group(task.s(resource_id, *args)
+                      for _, resource_id, _, task, args in entries
+                      ).apply_async()
+        except Exception as ex:
+            LOG.exception(ex)
+            with self._cond:
+                self.errors += len(entries)
+            return
+        with self._cond:
+            self.dispatched += len(entries)
+
+    def _flush(self, force=False):
+        now = time.monotonic()
+        with self._cond:
+            due = [(key, entry) for key, entry in self._pending.items()
+                   if force or entry[0] <= now]
+            for key, _ in due:
+                del self._pending[key]
+        if due:
+            self._publish([(resource, resource_id, kind, task, args)
+                           for (resource, resource_id), (_, kind, task, args)
+                           in due])
+
+    def _next_deadline(self):
+        return min((entry[0] for entry in self._pending.values()),
+                   default=None)
+
+    def _run(self):
+        next_log = time.monotonic() + STATS_LOG_INTERVAL
+        while True:
+            with self._cond:
+                if self._stopped:
+                    return
+                deadline = self._next_deadline()
+                timeout = STATS_LOG_INTERVAL if deadline is None \
+                    else max(0, deadline - time.monotonic())
+                self._cond.wait(timeout)
+                if self._stopped:
+                    return
+            self._flush()
+            if time.monotonic() >= next_log:
+                next_log = time.monotonic() + STATS_LOG_INTERVAL
+                LOG.info("Notification dispatcher: %s" % self.stats())
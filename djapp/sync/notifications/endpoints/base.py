@@ -2,6 +2,9 @@
 import logging
 import abc
 import copy
+import contextlib
+import threading
+import time
 
 import oslo_messaging
 
@@ -15,11 +18,30 @@ class NotificationEndpoint(metaclass=abc.ABCMeta):
     event_types = []
     """List of strings to filter messages on."""
 
-    def __init__(self, forwarder=None):
+    # metadata of the notification each listener thread is processing
+    _current = threading.local()
+
+    def __init__(self, forwarder=None, dispatcher=None, stats=None):
         if self.event_types:
             self.filter_rule = oslo_messaging.NotificationFilter(
                 event_type='|'.join(self.event_types))
         self.forwarder = forwarder
+        self.dispatcher = dispatcher
+        self.stats = stats
+
+    def dispatch(self, resource, resource_id, kind, task, *args):
+        """Send the sync task of a resource, coalesced by the dispatcher."""
+        if self.dispatcher is None:
+            LOG.info("%s %s: %s" % (kind.capitalize(), resource, resource_id))
+            task.delay(resource_id, *args)
+            return
+        self.dispatcher.submit(resource, resource_id, kind, task, *args)
+
+    def sent_at(self):
+        """Timestamp of the notification being processed, for the payloads
+        without their own update time."""
+        metadata = getattr(self._current, 'metadata', None) or {}
+        return metadata.get('timestamp')
 
     @abc.abstractmethod
     def process(self, publisher_id, event_type, payload):
@@ -32,13 +54,29 @@ class NotificationEndpoint(metaclass=abc.ABCMeta):
 
     def _process_notifications(self, context, publisher_id, event_type, payload, metadata):
         """RPC endpoint for all notification level"""
-        _, _ = context, metadata
+        _ = context
+        start = time.monotonic()
         try:
             LOG.info("Received: %s -- %s" % (publisher_id, event_type))
+            self._current.metadata = metadata
             self.process(publisher_id, event_type, payload)
         except Exception as e:
             LOG.exception(e)
             pass
+        finally:
+            if self.stats is not None:
+                self.stats.record(metadata, time.monotonic() - start)
+
+    def _process_batch(self, messages):
+        """Batch listener endpoint, the tasks of a batch are sent at once"""
+        batch = (self.dispatcher.batch() if self.dispatcher
+                 else contextlib.nullcontext())
+        with batch:
+            for message in messages:
+                self._process_notifications(
+                    message['ctxt'], message['publisher_id'],
+                    message['event_type'], message['payload'],
+                    message['metadata'])
 
     audit = _process_notifications
     critical = _process_notifications
@@ -49,6 +87,25 @@ class NotificationEndpoint(metaclass=abc.ABCMeta):
     warn = _process_notifications
 
 
+class BatchEndpoint(object):
+    """Adapt a NotificationEndpoint to the batch notification listener."""
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.filter_rule = getattr(endpoint, 'filter_rule', None)
+
+    def _process_batch(self, messages):
+        self.endpoint._process_batch(messages)
+
+    audit = _process_batch
+    critical = _process_batch
+    debug = _process_batch
+    error = _process_batch
+    info = _process_batch
+    sample = _process_batch
+    warn = _process_batch
+
+
 class Payload(object):
     def __init__(self, payload):
         self.__dict__.update(**payload)
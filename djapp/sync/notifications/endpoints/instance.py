@@ -4,6 +4,7 @@ import logging
 from sync.tasks import instance as instance_tasks
 
 from . import base
+from .. import dispatcher
 
 LOG = logging.getLogger(__name__)
 
@@ -31,6 +32,8 @@ INSTANCE_ACTION_EVENTS = (
 INSTANCE_DELETE_EVENTS = (
     'compute.instance.delete.end',
     'compute.instance.soft_delete.end',
+    'instance.delete.end',
+    'instance.soft_delete.end',
 )
 
 INSTANCE_ACTION_INTERFACE_EVENTS = (
@@ -78,7 +81,17 @@ INSTANCE_UPDATE_EVENTS = (
     'compute.instance.update',
 )
 
+# versioned notifications of the legacy instance action events
+INSTANCE_VERSIONED_EVENTS = tuple(
+    event_type[len('compute.'):] for event_type in (
+        *INSTANCE_ACTION_EVENTS,
+        *INSTANCE_ACTION_INTERFACE_EVENTS,
+        *INSTANCE_ACTION_VOLUME_EVENTS,
+        *INSTANCE_UPDATE_EVENTS,
+    ))
+
 INSTANCE_EVENTS = (
+    *INSTANCE_VERSIONED_EVENTS,
     *INSTANCE_ACTION_EVENTS,
     *INSTANCE_DELETE_EVENTS,
     *INSTANCE_ACTION_INTERFACE_EVENTS,
@@ -106,7 +119,12 @@ class InstanceEndpoint(base.NotificationEndpoint):
             LOG.warning('event_type: %s pass to process...' % event_type)
             return
 
-        instance_id = payload.get('instance_id')
+        # versioned notifications wrap the instance in nova_object.data
+        data = payload.get('nova_object.data')
+        if data:
+            instance_id = data.get('uuid')
+        else:
+            instance_id = payload.get('instance_id')
         if not instance_id:
             LOG.error("Failed to got `instance_id` from event: %s payload: %s"
                       % (event_type, payload))
@@ -117,16 +135,22 @@ class InstanceEndpoint(base.NotificationEndpoint):
 
         # delete instance
         if event_type in INSTANCE_DELETE_EVENTS:
-            LOG.info("Delete instance: %s" % instance_id)
-            instance_tasks.sync_instance_delete.delay(instance_id)
+            self.dispatch('instance', instance_id, dispatcher.KIND_DELETE,
+                          instance_tasks.sync_instance_delete)
             return
 
         # create instance
         if event_type in INSTANCE_CREATE_START_EVENTS:
-            # create instance:
-            LOG.info("Create instance: %s" % instance_id)
-            instance_tasks.sync_instance_create.delay(instance_id)
+            self.dispatch('instance', instance_id, dispatcher.KIND_CREATE,
+                          instance_tasks.sync_instance_create)
             return
 
-        # update instance
-        instance_tasks.sync_instance_update.delay(instance_id)
+        # update instance, from the versioned payload if it is complete
+        os_obj = instance_tasks.instance_from_payload(
+            data, self.sent_at()) if data else None
+        if os_obj:
+            self.dispatch('instance', instance_id, dispatcher.KIND_APPLY,
+                          instance_tasks.sync_instance_apply, os_obj)
+            return
+        self.dispatch('instance', instance_id, dispatcher.KIND_UPDATE,
+                      instance_tasks.sync_instance_update)
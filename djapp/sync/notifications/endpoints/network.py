@@ -4,6 +4,7 @@ import logging
 from sync.tasks import network as network_tasks
 
 from . import base
+from .. import dispatcher
 
 LOG = logging.getLogger(__name__)
 
@@ -47,19 +48,19 @@ class NetworkEndpoint(base.NotificationEndpoint):
 
             # delete network
             if event_type in ['network.delete.end']:
-                LOG.info("Delete network: %s" % network_id)
-                network_tasks.sync_network_delete.delay(network_id)
+                self.dispatch('network', network_id, dispatcher.KIND_DELETE,
+                              network_tasks.sync_network_delete)
                 return
 
             # create network
             if event_type in ['network.create.end', 'network.create.error']:
-                LOG.info("Create network: %s" % network_id)
-                network_tasks.sync_network_create.delay(network_id)
+                self.dispatch('network', network_id, dispatcher.KIND_CREATE,
+                              network_tasks.sync_network_create)
                 return
 
             # update network
-            LOG.info("Update network: %s" % network_id)
-            network_tasks.sync_network_update.delay(network_id)
+            self.dispatch('network', network_id, dispatcher.KIND_UPDATE,
+                          network_tasks.sync_network_update)
 
         if resource == 'port':
             port_id = self._get_port_id(payload)
@@ -70,17 +71,22 @@ class NetworkEndpoint(base.NotificationEndpoint):
 
             # delete port
             if event_type in ['port.delete.end']:
-                LOG.info("Delete port: %s" % port_id)
-                network_tasks.sync_port_delete.delay(port_id)
+                self.dispatch('port', port_id, dispatcher.KIND_DELETE,
+                              network_tasks.sync_port_delete)
                 return
 
             # create port
             if event_type in ['port.create.end', 'port.create.error']:
-                LOG.info("Create port: %s" % port_id)
-                network_tasks.sync_port_create.delay(port_id)
+                self.dispatch('port', port_id, dispatcher.KIND_CREATE,
+                              network_tasks.sync_port_create)
                 return
 
-            # update port
-            LOG.info("Update port: %s" % port_id)
-            network_tasks.sync_port_update.delay(port_id)
+            # update port, from the payload if it is complete
+            os_obj = network_tasks.port_from_payload(payload)
+            if os_obj:
+                self.dispatch('port', port_id, dispatcher.KIND_APPLY,
+                              network_tasks.sync_port_apply, os_obj)
+                return
+            self.dispatch('port', port_id, dispatcher.KIND_UPDATE,
+                          network_tasks.sync_port_update)
 
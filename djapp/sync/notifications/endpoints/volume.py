@@ -4,9 +4,15 @@ import logging
 from sync.tasks import volume as volume_tasks
 
 from . import base
+from .. import dispatcher
 
 LOG = logging.getLogger(__name__)
 
+# the payload only has the volume type id, fetch the renamed type
+VOLUME_FETCH_EVENTS = (
+    'volume.retype',
+)
+
 
 class VolumeEndpoint(base.NotificationEndpoint):
     """Volume Notification Process Endpoint."""
@@ -33,15 +39,21 @@ class VolumeEndpoint(base.NotificationEndpoint):
 
         # delete volume
         if event_type in ['volume.delete.end']:
-            LOG.info("Delete volume: %s" % volume_id)
-            volume_tasks.sync_volume_delete.delay(volume_id)
+            self.dispatch('volume', volume_id, dispatcher.KIND_DELETE,
+                          volume_tasks.sync_volume_delete)
+            return
 
         # create volume
         if event_type in ['volume.create.end', 'volume.create.error']:
-            LOG.info("Create volume: %s" % volume_id)
-            volume_tasks.sync_volume_create.delay(volume_id)
+            self.dispatch('volume', volume_id, dispatcher.KIND_CREATE,
+                          volume_tasks.sync_volume_create)
             return
 
-        # update volume:
-        LOG.info("Update volume: %s" % volume_id)
-        volume_tasks.sync_volume_update.delay(volume_id)
+        # update volume, from the payload if it is complete:
+        os_obj = volume_tasks.volume_from_payload(payload, self.sent_at())
+        if os_obj and event_type not in VOLUME_FETCH_EVENTS:
+            self.dispatch('volume', volume_id, dispatcher.KIND_APPLY,
+                          volume_tasks.sync_volume_apply, os_obj)
+            return
+        self.dispatch('volume', volume_id, dispatcher.KIND_UPDATE,
+                      volume_tasks.sync_volume_update)
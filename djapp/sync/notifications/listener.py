@@ -1,22 +1,85 @@
 
 import logging
+import threading
+import time
+
 import oslo_messaging
 
 from oslo_config import cfg
+from oslo_utils import timeutils
 from djapp import settings
 
+from . import dispatcher
 from . import endpoints
+from .endpoints import base
 
 LOG = logging.getLogger(__name__)
 
 
+class ListenerStats(object):
+    """Throughput and latency counters of the processed notifications.
+
+    The lag is measured from the notification timestamp, the processing
+    time only covers the endpoint call.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._started = time.monotonic()
+        self.processed = 0
+        self.processing_seconds = 0.0
+        self.lag_seconds = 0.0
+        self.lag_max = 0.0
+        self._last = (self._started, 0)
+
+    @staticmethod
+    def _lag(metadata):
+        try:
+            sent_at = timeutils.parse_isotime(metadata['timestamp'])
+        except Exception:
+            return None
+        return max(0.0, (timeutils.utcnow(True) - sent_at).total_seconds())
+
+    def record(self, metadata, seconds):
+        lag = self._lag(metadata or {})
+        with self._lock:
+            self.processed += 1
+            self.processing_seconds += seconds
+            if lag is not None:
+                self.lag_seconds += lag
+                self.lag_max = max(self.lag_max, lag)
+
+    def snapshot(self):
+        """Counters, with the rate since the previous snapshot."""
+        now = time.monotonic()
+        with self._lock:
+            last_at, last_processed = self._last
+            self._last = (now, self.processed)
+            processed = self.processed or 1
+            return {
+                'processed': self.processed,
+                'rate': round((self.processed - last_processed)
+                              / max(now - last_at, 1e-6), 2),
+                'avg_processing': round(self.processing_seconds / processed, 4),
+                'avg_lag': round(self.lag_seconds / processed, 3),
+                'max_lag': round(self.lag_max, 3),
+            }
+
+
 class NotificationListener(object):
 
     def __init__(self):
+        # one sync task per resource per coalescing window
+        self.dispatcher = dispatcher.CoalescingDispatcher(
+            window=settings.NOTIFICATION_COALESCE_WINDOW)
+        self.listener_stats = ListenerStats()
         self.endpoints = [
-            endpoints.InstanceEndpoint(),
-            endpoints.VolumeEndpoint(),
-            endpoints.NetworkEndpoint(),
+            endpoints.InstanceEndpoint(dispatcher=self.dispatcher,
+                                       stats=self.listener_stats),
+            endpoints.VolumeEndpoint(dispatcher=self.dispatcher,
+                                     stats=self.listener_stats),
+            endpoints.NetworkEndpoint(dispatcher=self.dispatcher,
+                                      stats=self.listener_stats),
         ]
 
     @staticmethod
@@ -24,8 +87,36 @@ class NotificationListener(object):
         # Init oslo config
         cfg.CONF([])
         LOG.info("TRANSPORT_URL: %s" % settings.TRANSPORT_URL)
-        return oslo_messaging.get_notification_transport(
+        transport = oslo_messaging.get_notification_transport(
             cfg.CONF, url=settings.TRANSPORT_URL)
+        if settings.NOTIFICATION_PREFETCH:
+            # rabbit options are registered by the transport driver
+            cfg.CONF.set_override('rabbit_qos_prefetch_count',
+                                  settings.NOTIFICATION_PREFETCH,
+                                  group='oslo_messaging_rabbit')
+        return transport
+
+    def stats(self):
+        return {
+            'listener': self.listener_stats.snapshot(),
+            'dispatcher': self.dispatcher.stats(),
+        }
+
+    def _get_server(self, transport, targets):
+        if settings.NOTIFICATION_BATCH_SIZE > 1:
+            return oslo_messaging.get_batch_notification_listener(
+                transport, targets,
+                endpoints=[base.BatchEndpoint(endpoint)
+                           for endpoint in self.endpoints],
+                executor=settings.NOTIFICATION_EXECUTOR,
+                allow_requeue=True,
+                batch_size=settings.NOTIFICATION_BATCH_SIZE,
+                batch_timeout=settings.NOTIFICATION_BATCH_TIMEOUT)
+        return oslo_messaging.get_notification_listener(
+            transport, targets,
+            endpoints=self.endpoints,
+            executor=settings.NOTIFICATION_EXECUTOR,
+            allow_requeue=True)
 
     def run(self):
         transport = self._get_transport()
@@ -33,15 +124,22 @@ class NotificationListener(object):
             oslo_messaging.Target(topic='versioned_notifications'),
             oslo_messaging.Target(topic='notifications'),
         ]
-        server = oslo_messaging.get_notification_listener(
-            transport, targets,
-            endpoints=self.endpoints,
-            executor='threading',
-            allow_requeue=True)
+        server = self._get_server(transport, targets)
+        # the server registers the pool option, read on start
+        cfg.CONF.set_override('executor_thread_pool_size',
+                              settings.NOTIFICATION_POOL_SIZE)
 
+        self.dispatcher.start()
         server.start()
-        LOG.info("messaging started, waiting to receiving ...")
-        server.wait()
+        LOG.info("messaging started with executor: %s, pool size: %s, "
+                 "batch size: %s, waiting to receiving ..."
+                 % (settings.NOTIFICATION_EXECUTOR,
+                    settings.NOTIFICATION_POOL_SIZE,
+                    settings.NOTIFICATION_BATCH_SIZE))
+        try:
+            server.wait()
+        finally:
+            self.dispatcher.stop()
         LOG.info("Done!")
 
 
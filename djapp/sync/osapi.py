@@ -1,10 +1,14 @@
+import itertools
 import os
+import threading
 
 import keystoneauth1
 from keystoneauth1 import loading
 
 from keystoneauth1.identity import v3 as v3_auth
 from keystoneauth1 import session as ks_session
+import requests
+from requests.adapters import HTTPAdapter
 
 from novaclient import client as nova_client
 from novaclient import exceptions as nova_exc
@@ -14,6 +18,10 @@ from cinderclient import client as cinder_client
 from cinderclient import exceptions as cinder_exc
 from neutronclient.v2_0 import client as neutron_client
 from neutronclient.common import exceptions as neutron_exc
+from oslo_utils import timeutils
+from openstack import connection as openstack_connection
+
+from sync import stats
 
 
 NOVA_API_VERSION = "2.53"
@@ -26,6 +34,15 @@ VOLUME_API_VERSION = "3.0"
 
 DEFAULT_PAGE_SIZE = 100
 
+# page size of the iter_* listings, keep it below the services max_limit
+PAGE_SIZE = int(os.getenv('OS_API_PAGE_SIZE', DEFAULT_PAGE_SIZE))
+
+# max ids per multi-valued filter, keeps the query string short
+FILTER_CHUNK_SIZE = 100
+
+# kept-alive connections per service endpoint
+HTTP_POOL_SIZE = int(os.getenv('OS_HTTP_POOL_SIZE', 10))
+
 
 def _get_session(auth_url, username, password,
                  project_name, user_domain_name, project_domain_name,
@@ -45,6 +62,16 @@ def _get_session(auth_url, username, password,
     return keystone_session
 
 
+def _http_session(pool_size=HTTP_POOL_SIZE):
+    """requests session keeping `pool_size` connections per endpoint."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.hooks['response'].append(stats.record_response)
+    return session
+
+
 def _get_session1(auth_url, username, password,
                   project_name, user_domain_name, project_domain_name):
     auth = v3_auth.Password(
@@ -55,7 +82,7 @@ def _get_session1(auth_url, username, password,
         user_domain_name=user_domain_name,
         project_domain_name=project_domain_name,
     )
-    return ks_session.Session(auth=auth)
+    return ks_session.Session(auth=auth, session=_http_session())
 
 
 def _make_session_from_env():
@@ -69,20 +96,35 @@ def _make_session_from_env():
 
 
 _SESSION = None
+_SESSION_LOCK = threading.Lock()
 _REGION_NAME = None
 
 
 def _session():
-    global _SESSION
+    """Keystone session shared by the clients of this process.
 
-    if _SESSION and not _SESSION.invalidate():
-        _SESSION = None
+    The auth plugin reuses its token until it is about to expire (and
+    re-authenticates on 401), so the session is never invalidated here.
+    """
+    global _SESSION
 
-    if not _SESSION:
-        _SESSION = _make_session_from_env()
+    if _SESSION is None:
+        with _SESSION_LOCK:
+            if _SESSION is None:
+                _SESSION = _make_session_from_env()
     return _SESSION
 
 
+def _reset_session():
+    global _SESSION, _SESSION_LOCK
+    _SESSION = None
+    _SESSION_LOCK = threading.Lock()
+
+
+# forked workers must not share the parent sockets
+os.register_at_fork(after_in_child=_reset_session)
+
+
 def _region_name():
     global _REGION_NAME
     if not _REGION_NAME:
@@ -90,6 +132,50 @@ def _region_name():
     return _REGION_NAME
 
 
+def _marker_pages(list_fn, page_size, to_dict=True, marker_fn=None):
+    """Yield pages of `list_fn(marker=..., limit=...)` until a short page."""
+    marker_fn = marker_fn or (lambda obj: obj.id)
+    marker = None
+    while True:
+        objs = list_fn(marker=marker, limit=page_size)
+        if objs:
+            yield [obj.to_dict() for obj in objs] if to_dict else list(objs)
+        if len(objs) < page_size:
+            return
+        marker = marker_fn(objs[-1])
+
+
+def _chunked_pages(objs, page_size):
+    """Group a lazily paginated iterator into lists of `page_size`."""
+    objs = iter(objs)
+    while True:
+        page = list(itertools.islice(objs, page_size))
+        if not page:
+            return
+        yield page
+
+
+def _isotime(at):
+    """UTC `changes-since` style timestamp of an aware datetime."""
+    return timeutils.normalize_time(at).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def _changed_pages(pages, changed_since, field='updated_at'):
+    """Cut pages sorted by `field` desc at the first older object.
+
+    Objects without `field` are sorted last, they end the listing too.
+    """
+    for page in pages:
+        kept = list(itertools.takewhile(
+            lambda obj: (obj.get(field) and
+                         timeutils.parse_isotime(obj[field]) >= changed_since),
+            page))
+        if kept:
+            yield kept
+        if len(kept) < len(page):
+            return
+
+
 def get_project_id():
     return _session().get_project_id()
 
@@ -98,6 +184,16 @@ def get_user_id():
     return _session().get_user_id()
 
 
+def get_connection():
+    """openstacksdk connection on the shared service session, for the jobs
+    run on behalf of the users: no user token goes through the broker."""
+    return openstack_connection.Connection(
+        session=_session(),
+        region_name=_region_name(),
+        interface=os.getenv('OS_INTERFACE', 'internal'),
+        identity_api_version=os.getenv('OS_IDENTITY_API_VERSION', '3'))
+
+
 class NovaAPI(object):
 
     def __init__(self, client=None):
@@ -132,6 +228,21 @@ class NovaAPI(object):
         # LOG.info('Fetch Server list...')
         return self.client.servers.list(detailed=True, search_opts=opts)
 
+    def iter_servers(self, all_tenants=True, project_id=None,
+                     page_size=None, changed_since=None):
+        opts = {}
+        if all_tenants:
+            opts['all_tenants'] = all_tenants
+        if project_id:
+            opts['project_id'] = project_id
+        if changed_since:
+            # also returns the servers deleted since then
+            opts['changes-since'] = _isotime(changed_since)
+        return _marker_pages(
+            lambda marker, limit: self.client.servers.list(
+                detailed=True, search_opts=opts, marker=marker, limit=limit),
+            page_size or PAGE_SIZE)
+
     def show_server(self, instance_id):
         try:
             return self.client.servers.get(instance_id)
@@ -141,8 +252,18 @@ class NovaAPI(object):
     def get_server_interfaces(self, instance_id):
         return self.client.servers.interface_list(instance_id)
 
-    def get_flavors(self, is_public=True):
-        return self.client.flavors.list(is_public=is_public)
+    def get_flavors(self, is_public=True, detailed=True):
+        return self.client.flavors.list(detailed=detailed, is_public=is_public)
+
+    def get_all_flavors(self, detailed=True):
+        """Public and private flavors, only id/name/links if not detailed."""
+        return self.get_flavors(is_public=None, detailed=detailed)
+
+    def iter_flavors(self, is_public=True, page_size=None):
+        return _marker_pages(
+            lambda marker, limit: self.client.flavors.list(
+                is_public=is_public, marker=marker, limit=limit),
+            page_size or PAGE_SIZE)
 
     def get_flavor_access(self, flavor_id):
         return self.client.flavor_access.list(flavor=flavor_id)
@@ -161,6 +282,14 @@ class NovaAPI(object):
     def get_user_keypairs(self, user_id):
         return self.client.keypairs.list(user_id)
 
+    def iter_keypairs(self, user_id=None, page_size=None, to_dict=True):
+        # keypairs are paged by name, since microversion 2.35
+        return _marker_pages(
+            lambda marker, limit: self.client.keypairs.list(
+                user_id=user_id, marker=marker, limit=limit),
+            page_size or PAGE_SIZE, to_dict=to_dict,
+            marker_fn=lambda kp: kp.name)
+
     def get_user_keypair_by_name(self, user_id, name):
         keypairs = self.get_user_keypairs(user_id)
         keypairs = (kp.to_dict() for kp in keypairs)
@@ -196,6 +325,14 @@ class GlanceAPI(object):
         }
         return self.client.images.list(**kwargs)
 
+    def iter_images(self, page_size=None, changed_since=None):
+        """Yield pages of images, glanceclient follows the `next` links."""
+        page_size = page_size or PAGE_SIZE
+        kwargs = {'page_size': page_size}
+        if changed_since:
+            kwargs['filters'] = {'updated_at': 'gte:%s' % _isotime(changed_since)}
+        return _chunked_pages(self.client.images.list(**kwargs), page_size)
+
     def get_image(self, image_id):
         try:
             return self.client.images.get(image_id)
@@ -233,6 +370,38 @@ class CinderAPI(object):
         return self.client.volumes.list(detailed=True,
                                         search_opts=search_opts)
 
+    def iter_volumes(self, project_id=None, page_size=None,
+                     changed_since=None):
+        """Yield pages of volume dicts using marker pagination.
+
+        The project filter is applied by Cinder, so only one page of
+        volumes is held in memory at a time. With `changed_since` the
+        volumes are sorted by updated_at and the listing stops at the
+        first older one (the 3.0 API has no updated_at filter). Volumes
+        never updated have a null updated_at sorted last, they are listed
+        by created_at in a second pass.
+        """
+        search_opts = {'all_tenants': True}
+        if project_id:
+            search_opts['project_id'] = project_id
+
+        def _pages(sort=None):
+            return _marker_pages(
+                lambda marker, limit: self.client.volumes.list(
+                    detailed=True, search_opts=search_opts,
+                    marker=marker, limit=limit, sort=sort),
+                page_size or PAGE_SIZE)
+
+        if not changed_since:
+            return _pages()
+        created_pages = (
+            [obj for obj in page if not obj.get('updated_at')]
+            for page in _changed_pages(_pages('created_at:desc'),
+                                       changed_since, 'created_at'))
+        return itertools.chain(
+            _changed_pages(_pages('updated_at:desc'), changed_since),
+            (page for page in created_pages if page))
+
     def show_volume(self, volume_id):
         try:
             return self.client.volumes.get(volume_id)
@@ -264,6 +433,43 @@ class NeutronAPI(object):
                                        insecure=insecure)
         return cls(client)
 
+    def _iter_pages(self, list_fn, collection, page_size=None, fields=None,
+                    **params):
+        """Yield the pages of a Neutron listing, following `next` links."""
+        params['limit'] = page_size or PAGE_SIZE
+        if fields:
+            params['fields'] = list(fields)
+        for page in list_fn(retrieve_all=False, **params):
+            if page.get(collection):
+                yield page[collection]
+
+    def iter_networks(self, page_size=None, fields=None, changed_since=None):
+        params = {}
+        if changed_since:
+            params['changed_since'] = _isotime(changed_since)
+        return self._iter_pages(self.client.list_networks, 'networks',
+                                page_size, fields, **params)
+
+    def iter_subnets(self, page_size=None, fields=None):
+        return self._iter_pages(self.client.list_subnets, 'subnets',
+                                page_size, fields)
+
+    def iter_ports(self, device_ids=None, page_size=None, fields=None,
+                   changed_since=None):
+        params = {}
+        if changed_since:
+            params['changed_since'] = _isotime(changed_since)
+        if device_ids is None:
+            yield from self._iter_pages(self.client.list_ports, 'ports',
+                                        page_size, fields, **params)
+            return
+
+        device_ids = [str(device_id) for device_id in device_ids]
+        for i in range(0, len(device_ids), FILTER_CHUNK_SIZE):
+            params['device_id'] = device_ids[i:i + FILTER_CHUNK_SIZE]
+            yield from self._iter_pages(self.client.list_ports, 'ports',
+                                        page_size, fields, **params)
+
     def get_networks(self, retrieve_all=True, tenant_id=None):
         params = {}
         if tenant_id:
@@ -272,20 +478,22 @@ class NeutronAPI(object):
 
     def show_network(self, network_id, expand_subnet=True, **params):
         network = self.client.show_network(network_id, **params).get('network', {})
-        if expand_subnet:
-            try:
-                network['subnets'] = [self.show_subnet(sid)
-                                      for sid in network['subnets']]
-            except neutron_exc.NotFound:
-                pass
+        if expand_subnet and network.get('subnets'):
+            # expand all subnets with a single list call
+            subnets = {subnet['id']: subnet for subnet in
+                       self.get_subnets(subnet_ids=network['subnets'])}
+            network['subnets'] = [subnets[sid] for sid in network['subnets']
+                                  if sid in subnets]
         return network
 
-    def get_subnets(self, tenant_id=None, network_id=None):
+    def get_subnets(self, tenant_id=None, network_id=None, subnet_ids=None):
         params = {}
         if tenant_id:
             params['tenant_id'] = tenant_id
         if network_id:
-            params['project_id'] = network_id
+            params['network_id'] = network_id
+        if subnet_ids:
+            params['id'] = list(subnet_ids)
         return self.client.list_subnets(**params).get('subnets', [])
 
     def show_subnet(self, subnet_id):
@@ -294,11 +502,21 @@ class NeutronAPI(object):
         except neutron_exc.NotFound:
             return None
 
-    def get_ports(self, network_id=None):
+    def get_ports(self, network_id=None, device_ids=None, fields=None):
         params = {}
         if network_id:
             params['network_id'] = network_id
-        return self.client.list_ports(**params).get('ports', [])
+        if fields:
+            params['fields'] = list(fields)
+        if device_ids is None:
+            return self.client.list_ports(**params).get('ports', [])
+
+        device_ids = [str(device_id) for device_id in device_ids]
+        ports = []
+        for i in range(0, len(device_ids), FILTER_CHUNK_SIZE):
+            params['device_id'] = device_ids[i:i + FILTER_CHUNK_SIZE]
+            ports.extend(self.client.list_ports(**params).get('ports', []))
+        return ports
 
     def show_port(self, port_id, **params):
         try:
@@ -0,0 +1,133 @@
+"""Counters of a sync run: OpenStack API calls, synced rows, phase timings.
+
+The stats of the running sync are bound to the current context, so the
+threads of a tenants sync must be started with `contextvars.copy_context()`.
+"""
+import contextlib
+import contextvars
+import re
+import threading
+import time
+from urllib import parse
+
+# API latency histogram upper bounds, in seconds
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_CURRENT = contextvars.ContextVar('sync_run_stats', default=None)
+
+# version, project id and uuid path segments are not resource names
+_SKIP_SEGMENT = re.compile(r'^(v\d+(\.\d+)?|[0-9a-f]{32}|[0-9a-f-]{36}|\d+)$')
+
+
+class RunStats(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.api_calls = {}
+        self.rows = {}
+        self.phases = {}
+
+    def record_api_call(self, name, seconds, error=False):
+        bucket = next((str(bound) for bound in LATENCY_BUCKETS
+                       if seconds <= bound), '+Inf')
+        with self._lock:
+            call = self.api_calls.setdefault(name, {
+                'count': 0, 'errors': 0, 'seconds': 0.0, 'max': 0.0,
+                'latency': {}})
+            call['count'] += 1
+            call['errors'] += 1 if error else 0
+            call['seconds'] += seconds
+            call['max'] = max(call['max'], seconds)
+            call['latency'][bucket] = call['latency'].get(bucket, 0) + 1
+
+    def record_rows(self, resource, result):
+        with self._lock:
+            rows = self.rows.setdefault(resource, {})
+            for key, value in result.items():
+                rows[key] = rows.get(key, 0) + value
+
+    def record_phase(self, name, seconds, error=False):
+        with self._lock:
+            phase = self.phases.setdefault(name, {
+                'count': 0, 'errors': 0, 'seconds': 0.0})
+            phase['count'] += 1
+            phase['errors'] += 1 if error else 0
+            phase['seconds'] += seconds
+
+    def error_count(self):
+        with self._lock:
+            return (sum(phase['errors'] for phase in self.phases.values()) +
+                    sum(rows.get('errors', 0) for rows in self.rows.values()))
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'api_calls': self.api_calls,
+                'rows': self.rows,
+                'phases': self.phases,
+            }
+
+
+def merge(dst, src):
+    """Add the `src` counters to `dst`, `max` values are maxed."""
+    for key, value in src.items():
+        if isinstance(value, dict):
+            merge(dst.setdefault(key, {}), value)
+        elif key == 'max':
+            dst[key] = max(dst.get(key, 0), value)
+        else:
+            dst[key] = dst.get(key, 0) + value
+    return dst
+
+
+def current():
+    return _CURRENT.get()
+
+
+@contextlib.contextmanager
+def collect(stats):
+    """Record the API calls, rows and phases of the block into `stats`."""
+    token = _CURRENT.set(stats)
+    try:
+        yield stats
+    finally:
+        _CURRENT.reset(token)
+
+
+@contextlib.contextmanager
+def phase(name):
+    start = time.monotonic()
+    error = False
+    try:
+        yield
+    except Exception:
+        error = True
+        raise
+    finally:
+        stats = current()
+        if stats is not None:
+            stats.record_phase(name, time.monotonic() - start, error)
+
+
+def record_rows(resource, result):
+    stats = current()
+    if stats is not None and isinstance(result, dict):
+        stats.record_rows(resource, result)
+
+
+def api_call_name(method, url):
+    """'GET servers' like name of an OpenStack API request."""
+    for segment in parse.urlparse(url).path.split('/'):
+        if segment and not _SKIP_SEGMENT.match(segment):
+            return '%s %s' % (method, segment)
+    return method
+
+
+def record_response(response, *args, **kwargs):
+    """requests response hook counting the OpenStack API calls."""
+    stats = current()
+    if stats is not None:
+        stats.record_api_call(
+            api_call_name(response.request.method, response.url),
+            response.elapsed.total_seconds(),
+            response.status_code >= 400)
@@ -1,100 +1,489 @@
 
+import copy
+import datetime
+import functools
 import logging
+import os
+import threading
 
+from django.conf import settings
+from django.core import exceptions
+from django.db import IntegrityError
+from django.db import models
+from django.db import transaction
+from django.utils import timezone
+from oslo_utils import timeutils
+
+from djapp import locks
+from sync import models as sync_models
 from sync import osapi
+from sync import stats
 
 
 LOG = logging.getLogger(__name__)
 
-_NOVA_API = None
-_CINDER_API = None
-_NEUTRON_API = None
-_GLANCE_API = None
+# service name -> api client, all built on the shared osapi session
+_CLIENTS = {}
+_CLIENTS_LOCK = threading.Lock()
 
 
-def nova_api():
-    global _NOVA_API
+def _client(name, create_fn):
+    client = _CLIENTS.get(name)
+    if client is None:
+        with _CLIENTS_LOCK:
+            client = _CLIENTS.get(name)
+            if client is None:
+                client = _CLIENTS[name] = create_fn()
+    return client
 
-    if not _NOVA_API:
-        _NOVA_API = osapi.NovaAPI.create()
 
-    return _NOVA_API
+def _reset_clients():
+    global _CLIENTS_LOCK
+    _CLIENTS.clear()
+    _CLIENTS_LOCK = threading.Lock()
 
 
-def glance_api():
-    global _GLANCE_API
+os.register_at_fork(after_in_child=_reset_clients)
 
-    if not _GLANCE_API:
-        _GLANCE_API = osapi.GlanceAPI.create()
 
-    return _GLANCE_API
+def nova_api():
+    return _client('nova', osapi.NovaAPI.create)
 
 
-def cinder_api():
-    global _CINDER_API
+def glance_api():
+    return _client('glance', osapi.GlanceAPI.create)
 
-    if not _CINDER_API:
-        _CINDER_API = osapi.CinderAPI.create()
 
-    return _CINDER_API
+def cinder_api():
+    return _client('cinder', osapi.CinderAPI.create)
 
 
 def neutron_api():
-    global _NEUTRON_API
-
-    if not _NEUTRON_API:
-        _NEUTRON_API = osapi.NeutronAPI.create()
-
-    return _NEUTRON_API
+    return _client('neutron', osapi.NeutronAPI.create)
 
 
 class SyncPass(Exception):
     pass
 
 
-def alg_sync(db_objects, db_obj_key_fn, os_objects, os_obj_key_fn,
-             create_db_fn, update_db_fn, remove_db_fn,
-             remove_allowed=True):
-    """Generic sync Resources method."""
-    # Objects to Dicts
-    exist_objects = {db_obj_key_fn(db_obj): db_obj for db_obj in db_objects}
-    new_objects = {os_obj_key_fn(os_obj): os_obj for os_obj in os_objects}
+def serialized(resource, fold=True):
+    """Run at most one sync task of a `resource` id at a time.
 
-    LOG.info("Want %s, Got %s" % (len(exist_objects), len(new_objects)))
+    The wrapped task takes the resource id as first argument. Two Postgres
+    advisory locks are held per id: `running` by the executing task and
+    `pending` by the single task waiting for it. With `fold`, a task that
+    finds both taken returns None at once, the pending one fetches the
+    latest state anyway. Tasks applying a notification payload must not
+    fold, the payload would be lost.
 
-    LOG.info("exist set: %s" % set(exist_objects))
-    LOG.info("new set: %s" % set(new_objects))
+    The locks are session level, released by the connection close on a
+    worker crash. Other database backends run the tasks unlocked.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(resource_id, *args, **kwargs):
+            if not locks.is_supported():
+                return fn(resource_id, *args, **kwargs)
 
-    for existed in exist_objects.values():
-        if db_obj_key_fn(existed) in set(exist_objects) - set(new_objects):
-            # Remove previously unknown resource.
-            if not remove_allowed:
-                LOG.warning("Will not remove unknown resource: %s" % db_obj_key_fn(existed))
-                continue
+            running = locks.advisory_key(resource, resource_id, 'running')
+            pending = locks.advisory_key(resource, resource_id, 'pending')
+            if fold and not locks.try_lock(pending):
+                LOG.info("%s %s sync already pending, fold %s"
+                         % (resource.capitalize(), resource_id, fn.__name__))
+                return None
             try:
-                existed_id = db_obj_key_fn(existed)
-                remove_db_fn(existed)
-                LOG.info("Removed previously unknown resource: %s" % existed_id)
-            except Exception as ex:
-                LOG.exception(ex)
-        else:
-            # Update tracked resources.
-            new_value = new_objects[db_obj_key_fn(existed)]
+                locks.lock(running)
+            finally:
+                if fold:
+                    locks.unlock(pending)
             try:
-                update_db_fn(existed, new_value)
-                LOG.info("Updated tracked resource: %s" % db_obj_key_fn(existed))
-            except SyncPass as ex:
-                LOG.warning("Pass update resource: %s for: %s" % (db_obj_key_fn(existed), ex))
-            except Exception as ex:
-                LOG.exception(ex)
+                return fn(resource_id, *args, **kwargs)
+            finally:
+                locks.unlock(running)
+        return wrapper
+    return decorator
+
+
+def diff_keys(exist_keys, new_keys):
+    """Diff two key collections in linear time.
+
+    Both arguments must support O(1) membership tests (dicts or sets).
+
+    :return: (removed, common, added) key lists.
+    """
+    removed = [key for key in exist_keys if key not in new_keys]
+    common = [key for key in exist_keys if key in new_keys]
+    added = [key for key in new_keys if key not in exist_keys]
+    return removed, common, added
+
+
+def _log_keys(exist_objects, new_objects):
+    LOG.info("Want %s, Got %s" % (len(exist_objects), len(new_objects)))
+    if LOG.isEnabledFor(logging.DEBUG):
+        LOG.debug("exist set: %s" % set(exist_objects))
+        LOG.debug("new set: %s" % set(new_objects))
+
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _sync_fields(model):
+    """Split model fields into compared fields and `auto_now` fields."""
+    fields = [f for f in model._meta.concrete_fields if not f.primary_key]
+    compare_fields = [f for f in fields if not getattr(f, 'auto_now', False)]
+    auto_now_fields = [f for f in fields if getattr(f, 'auto_now', False)]
+    return compare_fields, auto_now_fields
+
+
+def _prep_values(db_obj, fields):
+    values = []
+    for field in fields:
+        value = field.value_from_object(db_obj)
+        if isinstance(field, models.JSONField):
+            # compared as python values, key order is not kept by jsonb
+            values.append(copy.deepcopy(value))
+            continue
+        try:
+            value = field.get_prep_value(value)
+        except Exception:
+            pass
+        values.append(value)
+    return values
+
+
+def _changed_fields(fields, before, after):
+    return [f.name for f, old, new in zip(fields, before, after) if old != new]
+
+
+def update_changed(db_obj, convert_fn):
+    """Convert `db_obj` in place and save only the fields that changed.
+
+    Nothing is written (and `auto_now` timestamps are kept) when the
+    converted values are identical to the stored ones.
+
+    :return: list of changed field names.
+    """
+    compare_fields, auto_now_fields = _sync_fields(type(db_obj))
+    before = _prep_values(db_obj, compare_fields)
+    convert_fn(db_obj)
+    changed = _changed_fields(compare_fields, before,
+                              _prep_values(db_obj, compare_fields))
+    if changed:
+        db_obj.save(update_fields=changed + [f.name for f in auto_now_fields])
+    else:
+        LOG.info("Pass update unchanged resource: %s" % db_obj.pk)
+    return changed
+
+
+def parse_time(value):
+    """Aware datetime of an OpenStack timestamp, naive ones are UTC."""
+    if not value:
+        return None
+    if not isinstance(value, datetime.datetime):
+        value = timeutils.parse_isotime(value)
+    if timezone.is_naive(value):
+        value = timezone.make_aware(value, datetime.timezone.utc)
+    return value
+
+
+def is_outdated(changed_at, applied_at):
+    """Whether a change made at `changed_at` is older than `applied_at`, the
+    OpenStack time of the change the row already holds.
+
+    Notifications may be delivered out of order, an older payload must not
+    undo a newer one.
+    """
+    changed_at = parse_time(changed_at)
+    return bool(changed_at and applied_at and changed_at < applied_at)
+
+
+def alg_bulk_sync(model, db_objects, db_obj_key_fn, os_objects, os_obj_key_fn,
+                  convert_fn, remove_allowed=True, before_remove_fn=None,
+                  chunk_size=None):
+    """Bulk sync Resources method.
+
+    The diff of `plan_sync` is written with `bulk_create`, `bulk_update`
+    of the changed fields only and one `DELETE ... IN (...)` per chunk,
+    all inside one transaction. Rows whose converted fields are
+    identical to the stored ones are not written at all.
+
+    :param convert_fn: fill a db object from an os object, may raise SyncPass.
+    :param before_remove_fn: called with each chunk of db objects to remove.
+    :return: dict of created/updated/unchanged/removed/skipped/errors counts.
+    """
+    result = _bulk_sync(model, db_objects, db_obj_key_fn, os_objects,
+                        os_obj_key_fn, convert_fn, remove_allowed,
+                        before_remove_fn, chunk_size)
+    stats.record_rows(model.__name__, result)
+    return result
+
+
+def _new_result():
+    return dict.fromkeys(
+        ('created', 'updated', 'unchanged', 'removed', 'skipped', 'errors'), 0)
+
 
-    # Track newly discovered resources.
-    for os_obj in [os_obj for os_obj in new_objects.values() if
-                   os_obj_key_fn(os_obj) in set(new_objects) - set(exist_objects)]:
+def plan_sync(model, db_objects, db_obj_key_fn, os_objects, os_obj_key_fn,
+              convert_fn, remove_allowed=True, result=None):
+    """Diff and convert the objects of a bulk sync, nothing is written.
+
+    Skipped, failed and unchanged objects are counted in `result`.
+
+    :return: (to_create, to_update, to_remove, update_fields).
+    """
+    result = result if result is not None else _new_result()
+    exist_objects = {db_obj_key_fn(db_obj): db_obj for db_obj in db_objects}
+    new_objects = {os_obj_key_fn(os_obj): os_obj for os_obj in os_objects}
+
+    _log_keys(exist_objects, new_objects)
+    removed, common, added = diff_keys(exist_objects, new_objects)
+
+    compare_fields, auto_now_fields = _sync_fields(model)
+
+    to_create, to_update, to_remove = [], [], []
+    update_fields = set()
+
+    for key in removed:
+        if not remove_allowed:
+            LOG.warning("Will not remove unknown resource: %s" % key)
+            continue
+        to_remove.append(exist_objects[key])
+
+    for key in common:
+        db_obj = exist_objects[key]
+        try:
+            before = _prep_values(db_obj, compare_fields)
+            convert_fn(db_obj, new_objects[key])
+            after = _prep_values(db_obj, compare_fields)
+        except SyncPass as ex:
+            LOG.warning("Pass update resource: %s for: %s" % (key, ex))
+            result['skipped'] += 1
+            continue
+        except Exception as ex:
+            LOG.exception(ex)
+            result['errors'] += 1
+            continue
+
+        changed = _changed_fields(compare_fields, before, after)
+        if not changed:
+            result['unchanged'] += 1
+            continue
+        to_update.append(db_obj)
+        update_fields.update(changed)
+
+    for key in added:
+        db_obj = model()
         try:
-            create_db_fn(os_obj)
-            LOG.info("Tracked newly discovered resource: %s" % os_obj_key_fn(os_obj))
+            convert_fn(db_obj, new_objects[key])
         except SyncPass as ex:
-            LOG.warning("Pass create resource: %s for: %s" % (os_obj_key_fn(os_obj), ex))
+            LOG.warning("Pass create resource: %s for: %s" % (key, ex))
+            result['skipped'] += 1
+            continue
         except Exception as ex:
             LOG.exception(ex)
+            result['errors'] += 1
+            continue
+        to_create.append(db_obj)
+
+    if to_update and auto_now_fields:
+        now = timezone.now()
+        for db_obj in to_update:
+            for field in auto_now_fields:
+                setattr(db_obj, field.attname, now)
+        update_fields.update(f.name for f in auto_now_fields)
+
+    return to_create, to_update, to_remove, update_fields
+
+
+def _bulk_sync(model, db_objects, db_obj_key_fn, os_objects, os_obj_key_fn,
+               convert_fn, remove_allowed=True, before_remove_fn=None,
+               chunk_size=None):
+    chunk_size = chunk_size or settings.SYNC_BULK_CHUNK_SIZE
+    result = _new_result()
+    to_create, to_update, to_remove, update_fields = plan_sync(
+        model, db_objects, db_obj_key_fn, os_objects, os_obj_key_fn,
+        convert_fn, remove_allowed, result)
+
+    def _apply(action, objs, fn):
+        for chunk in _chunks(objs, chunk_size):
+            try:
+                with transaction.atomic():
+                    fn(chunk)
+                result[action] += len(chunk)
+                continue
+            except Exception as ex:
+                LOG.warning("%s %s chunk failed, retry row by row: %s"
+                            % (model.__name__, action, ex))
+            # one savepoint per row, only the failing rows are lost
+            for db_obj in chunk:
+                try:
+                    with transaction.atomic():
+                        fn([db_obj])
+                    result[action] += 1
+                except Exception as ex:
+                    LOG.error("Failed to sync %s resource: %s for: %s"
+                              % (model.__name__, db_obj.pk, ex))
+                    result['errors'] += 1
+
+    def _remove(chunk):
+        if before_remove_fn:
+            before_remove_fn(chunk)
+        model.objects.filter(pk__in=[db_obj.pk for db_obj in chunk]).delete()
+
+    with transaction.atomic():
+        _apply('removed', to_remove, _remove)
+        _apply('created', to_create, model.objects.bulk_create)
+        _apply('updated', to_update,
+               lambda chunk: model.objects.bulk_update(chunk, sorted(update_fields)))
+
+    LOG.info("Sync %s result: %s" % (model.__name__, result))
+    return result
+
+
+def _merge_results(result, other):
+    for key, value in other.items():
+        result[key] = result.get(key, 0) + value
+    return result
+
+
+def _is_valid_pk(model, key):
+    try:
+        model._meta.pk.to_python(key)
+    except exceptions.ValidationError:
+        return False
+    return True
+
+
+def alg_stream_sync(model, db_objects, os_pages, os_obj_key_fn, convert_fn,
+                    remove_allowed=True, before_remove_fn=None,
+                    chunk_size=None, partial=False, key_field='pk'):
+    """Streaming version of `alg_bulk_sync` for resources keyed by the
+    `key_field` of their rows, the primary key by default.
+
+    `os_pages` yields lists of os objects, each page is reconciled with the
+    db rows of the same keys as soon as it is received. Only the seen keys
+    are kept to remove the unknown rows of `db_objects` at the end, which
+    is skipped if the listing fails half way, or if the pages only hold
+    the changed objects (`partial`).
+    """
+    chunk_size = chunk_size or settings.SYNC_BULK_CHUNK_SIZE
+    key_in = key_field + '__in'
+    result = {}
+    seen = set()
+
+    def db_obj_key_fn(obj):
+        return str(getattr(obj, key_field))
+
+    for page in os_pages:
+        valid = [os_obj for os_obj in page
+                 if key_field != 'pk' or
+                 _is_valid_pk(model, os_obj_key_fn(os_obj))]
+        if len(valid) < len(page):
+            LOG.warning("Pass %s %s objects with an invalid id"
+                        % (len(page) - len(valid), model.__name__))
+            _merge_results(result, {'skipped': len(page) - len(valid)})
+            page = valid
+        keys = [os_obj_key_fn(os_obj) for os_obj in page]
+        seen.update(keys)
+        _merge_results(result, _bulk_sync(
+            model=model,
+            db_objects=db_objects.filter(**{key_in: keys}),
+            db_obj_key_fn=db_obj_key_fn,
+            os_objects=page,
+            os_obj_key_fn=os_obj_key_fn,
+            convert_fn=convert_fn,
+            chunk_size=chunk_size))
+
+    if partial:
+        LOG.info("Partial sync %s result: %s" % (model.__name__, result))
+        stats.record_rows(model.__name__, result)
+        return result
+
+    unknown = [key for key in
+               db_objects.values_list(key_field, flat=True).iterator()
+               if str(key) not in seen]
+    if unknown and not remove_allowed:
+        LOG.warning("Will not remove %s unknown resources" % len(unknown))
+    elif unknown:
+        for chunk in _chunks(unknown, chunk_size):
+            _merge_results(result, _bulk_sync(
+                model=model,
+                db_objects=db_objects.filter(**{key_in: chunk}),
+                db_obj_key_fn=db_obj_key_fn,
+                os_objects=[],
+                os_obj_key_fn=os_obj_key_fn,
+                convert_fn=convert_fn,
+                before_remove_fn=before_remove_fn,
+                chunk_size=chunk_size))
+
+    LOG.info("Stream sync %s result: %s" % (model.__name__, result))
+    stats.record_rows(model.__name__, result)
+    return result
+
+
+class Watermark(object):
+    """High-water mark of the incremental syncs of a resource type.
+
+    `since` is None when a full sync is due: incremental sync disabled or
+    forced off, no previous sync, or the last full reconcile is older than
+    SYNC_FULL_INTERVAL. Otherwise the objects changed since `since` are
+    enough, deleted resources are only removed by the next full sync.
+    """
+
+    def __init__(self, resource, project_id=None, full=False):
+        self.resource = resource
+        self.project_id = project_id or ''
+        self.started = timezone.now()
+        self.since = None if full else self._load_since()
+
+    @property
+    def is_full(self):
+        return self.since is None
+
+    def _load_since(self):
+        if not settings.SYNC_INCREMENTAL:
+            return None
+        mark = sync_models.SyncWatermark.objects.filter(
+            resource=self.resource, project_id=self.project_id).first()
+        if not mark or not mark.changed_since or not mark.full_synced_at:
+            return None
+        interval = datetime.timedelta(seconds=settings.SYNC_FULL_INTERVAL)
+        if mark.full_synced_at + interval <= self.started:
+            return None
+        # cover the clock drift between us and the OpenStack services
+        return mark.changed_since - datetime.timedelta(
+            seconds=settings.SYNC_WATERMARK_SKEW)
+
+    def commit(self, result=None):
+        """Move the mark to the sync start, unless some objects failed."""
+        if result and result.get('errors'):
+            LOG.warning("Keep %s watermark of project: %s, %s errors"
+                        % (self.resource, self.project_id, result['errors']))
+            return
+        marks = {'changed_since': self.started}
+        if self.is_full:
+            marks['full_synced_at'] = self.started
+        try:
+            self._save(marks)
+        except IntegrityError:
+            # an overlapping run created the mark first
+            self._save(marks)
+
+    def _save(self, marks):
+        with transaction.atomic():
+            mark, created = sync_models.SyncWatermark.objects \
+                .select_for_update().get_or_create(
+                    resource=self.resource, project_id=self.project_id,
+                    defaults=marks)
+            if created:
+                return
+            # never move back the marks of an overlapping later run
+            changed = [name for name, value in marks.items()
+                       if getattr(mark, name) is None or
+                       getattr(mark, name) < value]
+            for name in changed:
+                setattr(mark, name, marks[name])
+            if changed:
+                mark.save(update_fields=changed + ['updated_at'])
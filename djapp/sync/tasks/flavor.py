@@ -56,33 +56,15 @@ def _convert_flavor_from_os2db(db_obj, os_obj, is_public=True):
 
 def do_flavors_sync():
     db_objects = models.Flavor.objects.all()
-    os_objects = base.nova_api().get_flavors()
-    os_objects = [os_obj.to_dict() for os_obj in os_objects]
+    os_pages = base.nova_api().iter_flavors()
 
     LOG.info("Start to syncing all public Flavors ...")
 
-    def _remove_flavor(db_obj):
-        LOG.info("Remove unknown flavor: %s" % db_obj.id)
-        db_obj.save()
-
-    def _create_flavor(os_obj):
-        LOG.info("Create a new flavor: %s" % os_obj.get('id'))
-        db_obj = models.Flavor()
-        _convert_flavor_from_os2db(db_obj, os_obj)
-        # save to db:
-        db_obj.save()
-
-    def _update_flavor(db_obj, os_obj):
-        LOG.info("Update existed flavor: %s" % db_obj.id)
-        _convert_flavor_from_os2db(db_obj, os_obj)
-        # update to db:
-        db_obj.save()
-
-    base.alg_sync(db_objects=db_objects,
-                  db_obj_key_fn=lambda obj: str(obj.id),
-                  os_objects=os_objects,
-                  os_obj_key_fn=lambda obj: obj.get('id'),
-                  create_db_fn=_create_flavor,
-                  update_db_fn=_update_flavor,
-                  remove_db_fn=_remove_flavor)
+    # unknown flavors are kept, instances may still refer to them
+    return base.alg_stream_sync(model=models.Flavor,
+                                db_objects=db_objects,
+                                os_pages=os_pages,
+                                os_obj_key_fn=lambda obj: obj.get('id'),
+                                convert_fn=_convert_flavor_from_os2db,
+                                remove_allowed=False)
 
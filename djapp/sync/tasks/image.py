@@ -72,37 +72,20 @@ def _convert_image_from_os2db(db_obj, os_obj, user=None, project=None):
 
 
 @shared_task
-def do_images_sync():
+def do_images_sync(full=False):
     """Sync db objects with openstack information."""
+    mark = base.Watermark('image', full=full)
     db_objects = models.Image.objects.all()
-    os_objects = base.glance_api().get_images()
-    os_objects = [os_obj for os_obj in os_objects]
-
-    LOG.info("Start to sync images ...")
-
-    def _remove_image(db_obj):
-        LOG.info("Remove Unknown Image: %s" % db_obj)
-        db_obj.delete()
-
-    def _create_image(os_obj):
-        LOG.info("Create a new image: %s" % os_obj.get('id'))
-        # create db obj:
-        db_obj = models.Image()
-        _convert_image_from_os2db(db_obj, os_obj)
-        # save to db:
-        db_obj.save()
-
-    def _update_image(db_obj, os_obj):
-        LOG.info("Update existed image: %s" % db_obj.id)
-        _convert_image_from_os2db(db_obj, os_obj)
-        # update to db:
-        db_obj.save()
-
-    base.alg_sync(db_objects=db_objects,
-                  db_obj_key_fn=lambda obj: str(obj.id),
-                  os_objects=os_objects,
-                  os_obj_key_fn=lambda obj: str(obj['id']),
-                  create_db_fn=_create_image,
-                  update_db_fn=_update_image,
-                  remove_db_fn=_remove_image)
+    os_pages = base.glance_api().iter_images(changed_since=mark.since)
+
+    LOG.info("Start to sync images since: %s ..." % mark.since)
+
+    result = base.alg_stream_sync(model=models.Image,
+                                  db_objects=db_objects,
+                                  os_pages=os_pages,
+                                  os_obj_key_fn=lambda obj: str(obj['id']),
+                                  convert_fn=_convert_image_from_os2db,
+                                  partial=not mark.is_full)
+    mark.commit(result)
+    return result
 
@@ -6,6 +6,7 @@ from djapp import models
 from sync import osapi
 
 from . import base
+from . import lookup
 
 
 LOG = logging.getLogger(__name__)
@@ -69,7 +70,7 @@ def _convert_instance_from_os2db(db_obj, os_obj, user=None, project=None):
     flavor_name = flavor.get('original_name')
 
     # get flavor detail info:
-    os_flavor = base.nova_api().get_flavor_by_name(flavor_name)
+    os_flavor = lookup.get_flavor_by_name(flavor_name)
     if not os_flavor:
         LOG.warning("get flavor by name: %s failed!" % flavor_name)
     else:
@@ -91,7 +92,7 @@ def _convert_instance_from_os2db(db_obj, os_obj, user=None, project=None):
     user_id = os_obj.get('user_id')
     key_name = os_obj.get('key_name')
     if key_name:
-        keypair = base.nova_api().get_user_keypair_by_name(
+        keypair = lookup.get_user_keypair_by_name(
             user_id=user_id, name=key_name)
         if keypair:
             db_obj.keypair_id = keypair.get('id')
@@ -106,7 +107,7 @@ def _convert_instance_from_os2db(db_obj, os_obj, user=None, project=None):
     if isinstance(image, dict):
         image_id = image.get('id')
         # get image detail info:
-        image = base.glance_api().get_image(image_id)
+        image = lookup.get_image(image_id)
         if image:
             db_obj.os_type = image.get('os_type')
         else:
@@ -117,112 +118,195 @@ def _convert_instance_from_os2db(db_obj, os_obj, user=None, project=None):
     # // db.updater_name =
     # // db_obj.creator_id
     # // db_obj.creator_name
-    # db_obj.update_time = os_obj.get('updated')
+    db_obj.update_time = base.parse_time(os_obj.get('updated'))
     # db_obj.create_time = os_obj.get('created')
     db_obj.deleted = 1 if db_obj.status == 'DELETED' else 0
 
 
+# Nova API status of a vm_state, by task_state (nova.api.openstack.common)
+_RESIZE_TASKS = dict.fromkeys(
+    ('resize_prep', 'resize_migrating', 'resize_migrated', 'resize_finish'),
+    'RESIZE')
+_REBUILD_TASKS = dict.fromkeys(
+    ('rebuilding', 'rebuild_block_device_mapping', 'rebuild_spawning'),
+    'REBUILD')
+_INSTANCE_STATUS = {
+    'active': {
+        'default': 'ACTIVE',
+        'rebooting': 'REBOOT',
+        'reboot_pending': 'REBOOT',
+        'reboot_started': 'REBOOT',
+        'rebooting_hard': 'HARD_REBOOT',
+        'reboot_pending_hard': 'HARD_REBOOT',
+        'reboot_started_hard': 'HARD_REBOOT',
+        'updating_password': 'PASSWORD',
+        'migrating': 'MIGRATING',
+        **_RESIZE_TASKS,
+        **_REBUILD_TASKS,
+    },
+    'building': {'default': 'BUILD'},
+    'stopped': {'default': 'SHUTOFF', **_RESIZE_TASKS, **_REBUILD_TASKS},
+    'resized': {'default': 'VERIFY_RESIZE', 'resize_reverting': 'REVERT_RESIZE'},
+    'paused': {'default': 'PAUSED', 'migrating': 'MIGRATING'},
+    'suspended': {'default': 'SUSPENDED'},
+    'rescued': {'default': 'RESCUE'},
+    'error': {'default': 'ERROR', **_REBUILD_TASKS},
+    'deleted': {'default': 'DELETED'},
+    'soft-delete': {'default': 'SOFT_DELETED'},
+    'shelved': {'default': 'SHELVED'},
+    'shelved_offloaded': {'default': 'SHELVED_OFFLOADED'},
+}
+
+
+def _nova_object_data(payload):
+    return (payload or {}).get('nova_object.data') or {}
+
+
+def instance_from_payload(payload, sent_at=None):
+    """Build the instance dict `_convert_instance_from_os2db` reads from a
+    Nova versioned notification payload (InstancePayload data):
+    {
+        'uuid': '30a9c89f-2d43-45e0-b499-94c5bf70389c',
+        'display_name': 'qwer-2',
+        'state': 'active',
+        'task_state': None,
+        'tenant_id': '752df3ea70724f44acc088a0f0313579',
+        'user_id': 'f4e124ef1eea4ad8bf3c6e0983275dad',
+        'key_name': None,
+        'image_uuid': '60dadf62-5ca9-425c-9ab6-77783479b63c',
+        'flavor': {'nova_object.data': {'name': '1c1g10g', ...}, ...},
+        ...
+    }
+
+    `sent_at`, the time of the notification, stands for the update time
+    of the payloads without `updated_at`. Return None when a required
+    field is missing, the instance must be fetched from Nova then.
+    """
+    states = _INSTANCE_STATUS.get(payload.get('state'))
+    flavor_name = _nova_object_data(payload.get('flavor')).get('name')
+    required = (payload.get('uuid'), payload.get('tenant_id'),
+                payload.get('user_id'), states, flavor_name)
+    if not all(required) or 'key_name' not in payload:
+        return None
+
+    image_id = payload.get('image_uuid')
+    return {
+        'id': payload['uuid'],
+        'name': payload.get('display_name'),
+        'status': states.get(payload.get('task_state')) or states['default'],
+        'tenant_id': payload['tenant_id'],
+        'user_id': payload['user_id'],
+        'key_name': payload['key_name'],
+        'flavor': {'original_name': flavor_name},
+        # boot from volume servers have no image
+        'image': {'id': image_id} if image_id else '',
+        'updated': payload.get('updated_at') or sent_at,
+    }
+
+
 def _clear_instance_port_by_id(instance_id):
     for port_obj in models.InstancePort.objects.filter(server_id=instance_id):
         port_obj.delete()
 
 
 @shared_task
-def do_instances_sync(user=None, project=None):
+def do_instances_sync(user=None, project=None, full=False):
     project_id = project.get('id') if project else osapi.get_project_id()
+    mark = base.Watermark('instance', project_id, full)
 
     db_objects = models.Instance.objects.filter(project_id=project_id)
-    os_objects = base.nova_api().get_servers(project_id=project_id)
-    os_objects = [os_obj.to_dict() for os_obj in os_objects]
+    deleted_ids = []
 
-    LOG.info("Start to syncing Instances for project: %s..." % project_id)
+    def _os_pages():
+        for page in base.nova_api().iter_servers(project_id=project_id,
+                                                 changed_since=mark.since):
+            # changes-since also lists the servers deleted since then
+            deleted_ids.extend(os_obj.get('id') for os_obj in page
+                               if os_obj.get('status') == 'DELETED')
+            yield [os_obj for os_obj in page
+                   if os_obj.get('status') != 'DELETED']
 
-    def _remove_instance(db_obj):
-        LOG.info("Remove unknown instance: %s" % db_obj.id)
-        # remove instance ports db first
-        _clear_instance_port_by_id(db_obj.id)
-        # remove instance db:
-        db_obj.delete()
+    LOG.info("Start to syncing Instances for project: %s since: %s ..."
+             % (project_id, mark.since))
 
-    def _create_instance(os_obj):
-        LOG.info("Create a new instance: %s" % os_obj.get('id'))
-        db_obj = models.Instance()
+    def _convert_instance(db_obj, os_obj):
         _convert_instance_from_os2db(db_obj, os_obj, user, project)
-        # save to db:
-        db_obj.save()
 
-        # sync instance ports:
-        _do_sync_instance_ports(db_obj.id)
+    def _remove_instances_ports(db_objs):
+        # remove instance ports db first
+        models.InstancePort.objects.filter(
+            server_id__in=[db_obj.id for db_obj in db_objs]).delete()
+
+    result = base.alg_stream_sync(model=models.Instance,
+                                  db_objects=db_objects,
+                                  os_pages=_os_pages(),
+                                  os_obj_key_fn=lambda obj: obj.get('id'),
+                                  convert_fn=_convert_instance,
+                                  before_remove_fn=_remove_instances_ports,
+                                  partial=not mark.is_full)
+
+    if deleted_ids:
+        removed = base.alg_bulk_sync(model=models.Instance,
+                                     db_objects=db_objects.filter(pk__in=deleted_ids),
+                                     db_obj_key_fn=lambda obj: str(obj.id),
+                                     os_objects=[],
+                                     os_obj_key_fn=lambda obj: obj.get('id'),
+                                     convert_fn=_convert_instance,
+                                     before_remove_fn=_remove_instances_ports)
+        result['removed'] = result.get('removed', 0) + removed['removed']
+    mark.commit(result)
+
+    # sync the ports of all the project instances, the ports of an
+    # unchanged server may have been attached or detached too
+    try:
+        _do_sync_servers_ports(db_objects.values_list('pk', flat=True))
+    except Exception as ex:
+        LOG.exception(ex)
 
-    def _update_instance(db_obj, os_obj):
-        LOG.info("Update existed instance: %s" % db_obj.id)
-        _convert_instance_from_os2db(db_obj, os_obj, user, project)
-        # update to db:
-        db_obj.save()
+    return result
 
-        # sync instance ports:
-        _do_sync_instance_ports(db_obj.id)
 
-    base.alg_sync(db_objects=db_objects,
-                  db_obj_key_fn=lambda obj: str(obj.id),
-                  os_objects=os_objects,
-                  os_obj_key_fn=lambda obj: obj.get('id'),
-                  create_db_fn=_create_instance,
-                  update_db_fn=_update_instance,
-                  remove_db_fn=_remove_instance)
+INSTANCE_PORT_FIELDS = ('id', 'device_id', 'device_owner')
 
 
-def _convert_instance_port_from_os2db(server_id, db_obj, os_obj):
-    """OpenStack Instance Interface dict:
+def _convert_instance_port_from_os2db(db_obj, os_obj):
+    """OpenStack Neutron port dict of a server:
     {
-        'net_id': '92a1cbed-a8e7-4c67-aaab-76fa67b6ea5f',
-        'port_id': '0779769c-3420-42e7-aecc-3faa69c9d285',
-        'mac_addr': 'fa:16:3e:52:66:81',
-        'port_state': 'ACTIVE',
+        'id': '0779769c-3420-42e7-aecc-3faa69c9d285',
+        'network_id': '92a1cbed-a8e7-4c67-aaab-76fa67b6ea5f',
+        'device_id': 'b8a5030a-06a7-4f8c-a3b6-723a1f92c35f',
+        'device_owner': 'compute:nova',
         'fixed_ips': [{
             'subnet_id': '221e5f89-8000-4bdc-b03b-099b6dee910c',
             'ip_address': '10.20.30.222'
-        }]
+        }],
+        ...
     }
     """
-    db_obj.id = os_obj.get('port_id')
-    db_obj.server_id = server_id
-    db_obj.port_id = os_obj.get('port_id')
+    db_obj.id = os_obj.get('id')
+    db_obj.server_id = os_obj.get('device_id')
+    db_obj.port_id = os_obj.get('id')
     # db_obj.created
     # db_obj.modified
 
 
-def _do_sync_instance_ports(server_id):
-    db_objects = models.InstancePort.objects.filter(server_id=server_id)
-    os_objects = base.nova_api().get_server_interfaces(server_id)
-    os_objects = [os_obj.to_dict() for os_obj in os_objects]
-
-    LOG.info("Start to syncing Ports of Instance: %s ..." % server_id)
-
-    def _remove_instance_port(db_obj):
-        LOG.info("Remove unknown instance: %s port: %s" % (server_id, db_obj.id))
-        db_obj.delete()
-
-    def _create_instance_port(os_obj):
-        LOG.info("Create instance: %s port: %s" % (server_id, os_obj.get('port_id')))
-        db_obj = models.InstancePort()
-        _convert_instance_port_from_os2db(server_id, db_obj, os_obj)
-        # save to db:
-        db_obj.save()
+def _do_sync_servers_ports(server_ids):
+    """Sync ports of servers from Neutron ports filtered by device id,
+    instead of a nova interface list call per server."""
+    server_ids = set(str(server_id) for server_id in server_ids)
+    db_objects = models.InstancePort.objects.filter(server_id__in=server_ids)
+    os_pages = ([os_obj for os_obj in page
+                 if (os_obj.get('device_owner') or '').startswith('compute:')]
+                for page in base.neutron_api().iter_ports(
+                    device_ids=server_ids, fields=INSTANCE_PORT_FIELDS))
 
-    def _update_instance_port(db_obj, os_obj):
-        LOG.info("Update existed instance: %s port: %s" % (server_id, db_obj.id))
-        _convert_instance_port_from_os2db(server_id, db_obj, os_obj)
-        # update to db:
-        db_obj.save()
+    LOG.info("Start to syncing Ports of %s Instances ..." % len(server_ids))
 
-    base.alg_sync(db_objects=db_objects,
-                  db_obj_key_fn=lambda obj: str(obj.id),
-                  os_objects=os_objects,
-                  os_obj_key_fn=lambda obj: obj.get('port_id'),
-                  create_db_fn=_create_instance_port,
-                  update_db_fn=_update_instance_port,
-                  remove_db_fn=_remove_instance_port)
+    return base.alg_stream_sync(model=models.InstancePort,
+                                db_objects=db_objects,
+                                os_pages=os_pages,
+                                os_obj_key_fn=lambda obj: obj.get('id'),
+                                convert_fn=_convert_instance_port_from_os2db)
 
 
 def db_get_instance(instance_id):
@@ -233,6 +317,7 @@ def db_get_instance(instance_id):
 
 
 @shared_task
+@base.serialized('instance')
 def sync_instance_delete(instance_id):
     db_obj = db_get_instance(instance_id)
     if not db_obj:
@@ -246,6 +331,7 @@ def sync_instance_delete(instance_id):
 
 
 @shared_task
+@base.serialized('instance')
 def sync_instance_create(instance_id):
     db_obj = db_get_instance(instance_id)
     if db_obj:
@@ -265,6 +351,7 @@ def sync_instance_create(instance_id):
 
 
 @shared_task
+@base.serialized('instance')
 def sync_instance_update(instance_id):
     db_obj = db_get_instance(instance_id)
     if not db_obj:
@@ -279,5 +366,24 @@ def sync_instance_update(instance_id):
         return
 
     # update instance
-    _convert_instance_from_os2db(db_obj, os_obj.to_dict())
-    db_obj.save()
+    base.update_changed(
+        db_obj, lambda obj: _convert_instance_from_os2db(obj, os_obj.to_dict()))
+
+
+@shared_task
+@base.serialized('instance', fold=False)
+def sync_instance_apply(instance_id, os_obj):
+    """Update the instance from a notification payload (`instance_from_payload`)
+    instead of fetching it from Nova."""
+    db_obj = db_get_instance(instance_id)
+    if not db_obj:
+        LOG.warning("Could not found instance %s in db, pass to update ..."
+                    % instance_id)
+        return
+    if base.is_outdated(os_obj.get('updated'), db_obj.update_time):
+        LOG.info("Pass outdated payload of instance %s: %s" % (
+            instance_id, os_obj.get('updated')))
+        return
+
+    base.update_changed(
+        db_obj, lambda obj: _convert_instance_from_os2db(obj, os_obj))
@@ -49,32 +49,18 @@ def do_key_pairs_sync(user=None, project=None):
     rel_user_id = user.get('relUserId') if user else osapi.get_user_id()
     # filter by openstack user id:
     db_objects = models.Keypair.objects.filter(rel_user_id=rel_user_id)
-    os_objects = base.nova_api().get_user_keypairs(user_id=rel_user_id)
+    os_pages = base.nova_api().iter_keypairs(user_id=rel_user_id,
+                                             to_dict=False)
 
     LOG.info("Start to syncing Keypairs for user: %s ..." % rel_user_id)
 
-    def _remove_keypair(db_obj):
-        LOG.info("Remove unknown keypair %s" % db_obj.name)
-        db_obj.delete()
-
-    def _create_keypair(os_obj):
-        LOG.info("Create a new keypair: %s" % os_obj)
-        db_obj = models.Keypair()
+    def _convert_keypair(db_obj, os_obj):
         _convert_keypair_from_os2_db(db_obj, os_obj, user, project)
-        # save to db:
-        db_obj.save()
 
-    def _update_keypair(db_obj, os_obj):
-        LOG.info("Update existed keypair %s from %s" % (db_obj.name, os_obj.name))
-        _convert_keypair_from_os2_db(db_obj, os_obj, user, project)
-        # update to db:
-        db_obj.save()
-
-    base.alg_sync(db_objects=db_objects,
-                  db_obj_key_fn=lambda obj: obj.name,
-                  os_objects=os_objects,
-                  os_obj_key_fn=lambda obj: obj.name,
-                  create_db_fn=_create_keypair,
-                  update_db_fn=_update_keypair,
-                  remove_db_fn=_remove_keypair)
+    return base.alg_stream_sync(model=models.Keypair,
+                                db_objects=db_objects,
+                                os_pages=os_pages,
+                                os_obj_key_fn=lambda obj: obj.name,
+                                convert_fn=_convert_keypair,
+                                key_field='name')
 
@@ -0,0 +1,151 @@
+import logging
+import threading
+import time
+
+from django.conf import settings
+
+from djapp import models
+from djapp.cache import LRUCache
+
+from . import base
+
+LOG = logging.getLogger(__name__)
+
+
+class ListIndex(object):
+    """Key -> object index built from a single OpenStack list call.
+
+    The index is shared by full syncs and notification tasks of a worker.
+    It is rebuilt when older than `ttl`, or on a key miss when older than
+    `miss_refresh` seconds, so newly created resources are found quickly
+    without listing on every miss.
+    """
+
+    def __init__(self, name, load_fn, key_fn, ttl=None, miss_refresh=None):
+        self.name = name
+        self.load_fn = load_fn
+        self.key_fn = key_fn
+        self.ttl = ttl if ttl is not None else settings.SYNC_LOOKUP_TTL
+        self.miss_refresh = miss_refresh if miss_refresh is not None \
+            else settings.SYNC_LOOKUP_MISS_REFRESH
+        self._lock = threading.Lock()
+        self._index = None
+        self._loaded_at = 0
+
+    def _load(self):
+        index = {}
+        for obj in self.load_fn():
+            index[self.key_fn(obj)] = obj
+        self._index = index
+        self._loaded_at = time.monotonic()
+        LOG.info("Loaded %s index with %s items" % (self.name, len(index)))
+
+    def get(self, key):
+        with self._lock:
+            age = time.monotonic() - self._loaded_at
+            if self._index is None or age > self.ttl:
+                self._load()
+            elif key not in self._index and age > self.miss_refresh:
+                self._load()
+            return self._index.get(key)
+
+    def invalidate(self):
+        with self._lock:
+            self._index = None
+
+
+def _load_flavors():
+    # instances only need the flavor id by name
+    return (flavor.to_dict() for flavor in
+            base.nova_api().get_all_flavors(detailed=False))
+
+
+FLAVORS = ListIndex('flavor', _load_flavors, lambda flavor: flavor.get('name'))
+
+
+def get_flavor_by_name(name):
+    return FLAVORS.get(name)
+
+
+# the indexes of the least recently synced users are dropped
+_KEYPAIRS = LRUCache(maxsize=settings.SYNC_LOOKUP_KEYPAIR_USERS,
+                     ttl=settings.SYNC_LOOKUP_TTL)
+_KEYPAIRS_LOCK = threading.Lock()
+
+
+def _user_keypairs_index(user_id):
+    with _KEYPAIRS_LOCK:
+        index = _KEYPAIRS.get(user_id)
+        if index is None:
+            index = ListIndex(
+                'keypair of user %s' % user_id,
+                lambda: (kp for page in
+                         base.nova_api().iter_keypairs(user_id=user_id)
+                         for kp in page),
+                lambda kp: kp.get('name'))
+            _KEYPAIRS.set(user_id, index)
+        return index
+
+
+def get_user_keypair_by_name(user_id, name):
+    """Keypairs are listed once per user instead of once per server."""
+    return _user_keypairs_index(user_id).get(name)
+
+
+# images missing from the listing are mostly deleted ones, look them up
+# one by one (and remember the answer) instead of relisting everything.
+IMAGES = ListIndex('image', lambda: base.glance_api().get_images(),
+                   lambda image: image.get('id'),
+                   miss_refresh=settings.SYNC_LOOKUP_TTL)
+
+_IMAGE_MISSES = LRUCache(maxsize=1024, ttl=settings.SYNC_LOOKUP_TTL)
+
+
+def get_image(image_id):
+    image = IMAGES.get(image_id)
+    if image is not None:
+        return image
+
+    image = _IMAGE_MISSES.get(image_id)
+    if image is None:
+        image = base.glance_api().get_image(image_id) or {}
+        _IMAGE_MISSES.set(image_id, image)
+    return image or None
+
+
+class ServerNameResolver(object):
+    """Resolve server names of a project during one volume sync run.
+
+    Names come from the local Instance table first, misses are resolved
+    by a single servers list of the project, then one by one for servers
+    of other projects. Every answer is kept for the resolver lifetime.
+    """
+
+    def __init__(self, project_id):
+        self.project_id = project_id
+        self._names = None
+        self._listed = False
+
+    def _load_local(self):
+        self._names = {
+            str(server_id): name for server_id, name in
+            models.Instance.objects.filter(
+                project_id=self.project_id).values_list('id', 'name')
+        }
+
+    def _load_remote(self):
+        self._listed = True
+        for page in base.nova_api().iter_servers(project_id=self.project_id):
+            for server in page:
+                self._names[server.get('id')] = server.get('name')
+
+    def get(self, server_id):
+        server_id = str(server_id)
+        if self._names is None:
+            self._load_local()
+        if server_id not in self._names and not self._listed:
+            self._load_remote()
+        if server_id not in self._names:
+            server = base.nova_api().show_server(server_id)
+            self._names[server_id] = server.name if server else None
+        return self._names[server_id]
@@ -9,6 +9,11 @@ from . import base
 LOG = logging.getLogger(__name__)
 
 
+# fields read by the converters, requested with Neutron `fields=`
+PORT_FIELDS = ('id', 'name', 'network_id', 'fixed_ips', 'mac_address',
+               'device_id', 'device_owner', 'created_at', 'updated_at')
+
+
 def _convert_port_from_os2db(db_obj, os_obj, creator_id=None):
     """OpenStack port dict:
     {
@@ -59,41 +64,79 @@ def _convert_port_from_os2db(db_obj, os_obj, creator_id=None):
 
     db_obj.created = os_obj.get('created_at')
     db_obj.modified = os_obj.get('updated_at')
+    db_obj.os_updated_at = base.parse_time(os_obj.get('updated_at'))
 
 
-def _do_network_ports_sync(network_id, creator_id=None):
-    db_objects = models.Port.objects.filter(network_id=network_id)
-    os_objects = base.neutron_api().get_ports(network_id=network_id)
+def port_from_payload(payload):
+    """Neutron port notifications carry the whole port dict, return it if
+    it has all the PORT_FIELDS, the port must be fetched otherwise."""
+    port = payload.get('port') or {}
+    if any(field not in port for field in PORT_FIELDS) or \
+            not port.get('fixed_ips'):
+        return None
+    return {field: port[field] for field in PORT_FIELDS}
+
 
-    LOG.info("Start to syncing Ports of Network: %s ..." % network_id)
+def _do_ports_sync(network_ids, os_ports, creator_id=None):
+    """Sync ports of the given networks from an already fetched port list."""
+    network_ids = set(str(network_id) for network_id in network_ids)
+    db_objects = models.Port.objects.filter(network_id__in=network_ids)
+    os_objects = [os_obj for os_obj in os_ports
+                  if os_obj.get('network_id') in network_ids]
 
-    def _create_network_port(os_obj):
-        LOG.info("Create a network: %s port: %s" % (network_id, os_obj.get('id')))
-        db_obj = models.Port()
+    LOG.info("Start to syncing Ports of %s Networks ..." % len(network_ids))
+
+    def _convert_port(db_obj, os_obj):
         _convert_port_from_os2db(db_obj, os_obj, creator_id)
-        # save to db:
-        db_obj.save()
 
-    def _update_network_port(db_obj, os_obj):
-        LOG.info("Update existed network: %s port: %s" % (network_id, db_obj.id))
+    return base.alg_bulk_sync(model=models.Port,
+                              db_objects=db_objects,
+                              db_obj_key_fn=lambda obj: str(obj.id),
+                              os_objects=os_objects,
+                              os_obj_key_fn=lambda obj: obj.get('id'),
+                              convert_fn=_convert_port)
+
+
+def _do_all_ports_sync(creator_id=None, full=False):
+    """Stream all ports of the tracked networks page by page."""
+    mark = base.Watermark('port', full=full)
+    network_ids = set(str(network_id) for network_id in
+                      models.Network.objects.values_list('pk', flat=True))
+    os_pages = ([os_obj for os_obj in page
+                 if os_obj.get('network_id') in network_ids]
+                for page in base.neutron_api().iter_ports(
+                    fields=PORT_FIELDS, changed_since=mark.since))
+
+    LOG.info("Start to syncing Ports of %s Networks since: %s ..."
+             % (len(network_ids), mark.since))
+
+    def _convert_port(db_obj, os_obj):
         _convert_port_from_os2db(db_obj, os_obj, creator_id)
-        # update to db:
-        db_obj.save()
 
-    def _remove_network_port(db_obj):
-        LOG.info("Remove unknown network: %s port: %s" % (network_id, db_obj.id))
-        db_obj.delete()
+    result = base.alg_stream_sync(model=models.Port,
+                                  db_objects=models.Port.objects.all(),
+                                  os_pages=os_pages,
+                                  os_obj_key_fn=lambda obj: obj.get('id'),
+                                  convert_fn=_convert_port,
+                                  partial=not mark.is_full)
+    mark.commit(result)
+    return result
+
+
+def _do_network_ports_sync(network_id, creator_id=None):
+    os_ports = base.neutron_api().get_ports(network_id=network_id,
+                                            fields=PORT_FIELDS)
+    return _do_ports_sync([network_id], os_ports, creator_id)
+
 
-    base.alg_sync(db_objects=db_objects,
-                  db_obj_key_fn=lambda obj: str(obj.id),
-                  os_objects=os_objects,
-                  os_obj_key_fn=lambda obj: obj.get('id'),
-                  create_db_fn=_create_network_port,
-                  update_db_fn=_update_network_port,
-                  remove_db_fn=_remove_network_port)
+NETWORK_FIELDS = ('id', 'name', 'subnets', 'shared',
+                  'provider:segmentation_id', 'tenant_id',
+                  'created_at', 'updated_at')
 
+SUBNET_FIELDS = ('id', 'cidr')
 
-def _convert_network_from_os2db(db_obj, os_obj, creator_id=None):
+
+def _convert_network_from_os2db(db_obj, os_obj, creator_id=None, subnets=None):
     """OpenStack network dict:
     {
         'id': '275d3a55-bb1c-41a5-bc41-d1b286681e58',
@@ -145,18 +188,28 @@ def _convert_network_from_os2db(db_obj, os_obj, creator_id=None):
         'revision_number': 0,
         'project_id': '752df3ea70724f44acc088a0f0313579'
     }
+
+    `subnets` is an optional id -> subnet dict of prefetched subnets,
+    the network `subnets` may also be already expanded to subnet dicts.
     """
     db_obj.id = os_obj.get('id')
     db_obj.os_network_id = os_obj.get('id')
 
-    subnets = os_obj.get('subnets')
-    if not subnets:
+    os_subnets = os_obj.get('subnets')
+    if not os_subnets:
         raise base.SyncPass("Network subnets is empty!")
 
-    db_obj.os_subnet_id = subnets[0]
+    if isinstance(os_subnets[0], dict):
+        subnet = os_subnets[0]
+        db_obj.os_subnet_id = subnet.get('id')
+    else:
+        db_obj.os_subnet_id = os_subnets[0]
+        if subnets is not None:
+            subnet = subnets.get(db_obj.os_subnet_id)
+        else:
+            subnet = base.neutron_api().show_subnet(db_obj.os_subnet_id)
 
-    subnet = base.neutron_api().show_subnet(db_obj.os_subnet_id)
-    cidr = subnet.get('cidr')
+    cidr = (subnet or {}).get('cidr')
     if not cidr:
         raise base.SyncPass("CIDR is empty!")
     db_obj.cidr = cidr
@@ -190,46 +243,48 @@ def _clear_network_port(db_obj):
 
 
 @shared_task
-def do_networks_sync(creator_id=None):
+def do_networks_sync(creator_id=None, full=False):
+    mark = base.Watermark('network', full=full)
     # filter by user_id and project_id
     db_objects = models.Network.objects.filter()
-    os_objects = base.neutron_api().get_networks()
-
-    LOG.info("Start to sync all networks ...")
-
-    def _remove_network(db_obj):
-        LOG.info("Remove unknown network: %s" % db_obj.id)
+    os_pages = base.neutron_api().iter_networks(fields=NETWORK_FIELDS,
+                                                changed_since=mark.since)
+    os_subnets = None
+    if mark.is_full:
+        # fetch all subnets at once instead of per network, the few
+        # changed networks of an incremental sync show theirs
+        os_subnets = {subnet['id']: subnet
+                      for page in base.neutron_api().iter_subnets(
+                          fields=SUBNET_FIELDS)
+                      for subnet in page}
+
+    LOG.info("Start to sync all networks since: %s ..." % mark.since)
+
+    def _convert_network(db_obj, os_obj):
+        _convert_network_from_os2db(db_obj, os_obj, creator_id, os_subnets)
+
+    def _remove_networks_ports(db_objs):
         # remove network ports first:
-        _clear_network_port(db_obj)
-        # remove network db:
-        db_obj.delete()
-
-    def _create_network(os_obj):
-        LOG.info("Create a new network: %s" % os_obj.get('id'))
-        db_obj = models.Network()
-        _convert_network_from_os2db(db_obj, os_obj, creator_id)
-        # save to db:
-        db_obj.save()
-
-        # sync network ports:
-        _do_network_ports_sync(db_obj.id, creator_id)
-
-    def _update_network(db_obj, os_obj):
-        LOG.info("Update existed network: %s" % db_obj.id)
-        _convert_network_from_os2db(db_obj, os_obj, creator_id)
-        # update to db:
-        db_obj.save()
-
-        # sync network ports:
-        _do_network_ports_sync(db_obj.id, creator_id)
+        models.Port.objects.filter(
+            network_id__in=[db_obj.id for db_obj in db_objs]).delete()
+
+    result = base.alg_stream_sync(model=models.Network,
+                                  db_objects=db_objects,
+                                  os_pages=os_pages,
+                                  os_obj_key_fn=lambda obj: obj.get('id'),
+                                  convert_fn=_convert_network,
+                                  before_remove_fn=_remove_networks_ports,
+                                  partial=not mark.is_full)
+    mark.commit(result)
+
+    # sync network ports of the tracked networks, ports of the removed
+    # networks are already gone:
+    try:
+        _do_all_ports_sync(creator_id, full)
+    except Exception as ex:
+        LOG.exception(ex)
 
-    base.alg_sync(db_objects=db_objects,
-                  db_obj_key_fn=lambda obj: str(obj.id),
-                  os_objects=os_objects,
-                  os_obj_key_fn=lambda obj: obj.get('id'),
-                  create_db_fn=_create_network,
-                  update_db_fn=_update_network,
-                  remove_db_fn=_remove_network)
+    return result
 
 
 def db_get_port(port_id):
@@ -247,6 +302,7 @@ def db_get_network(network_id):
 
 
 @shared_task
+@base.serialized('port')
 def sync_port_delete(port_id):
     db_obj = db_get_port(port_id)
     if db_obj is None:
@@ -259,13 +315,15 @@ def sync_port_delete(port_id):
 
 
 @shared_task
+@base.serialized('port')
 def sync_port_create(port_id):
     db_obj = db_get_port(port_id)
     if db_obj:
         LOG.warning("Port %s already exist, pass to create..." % port_id)
         return
 
-    os_obj = base.neutron_api().show_port(port_id=port_id)
+    os_obj = base.neutron_api().show_port(port_id=port_id,
+                                          fields=PORT_FIELDS)
     if not os_obj:
         LOG.error("Unknown port: %s in openstack..." % port_id)
         return
@@ -277,6 +335,7 @@ def sync_port_create(port_id):
 
 
 @shared_task
+@base.serialized('port')
 def sync_port_update(port_id):
     db_obj = db_get_port(port_id)
     if db_obj is None:
@@ -284,18 +343,39 @@ def sync_port_update(port_id):
                     % port_id)
         return
 
-    os_obj = base.neutron_api().show_port(port_id=port_id)
+    os_obj = base.neutron_api().show_port(port_id=port_id,
+                                          fields=PORT_FIELDS)
     if not os_obj:
         LOG.error("Unknown port: %s in openstack, will remove residual db data..." % port_id)
         db_obj.delete()
         return
 
     # Update existed info
-    _convert_port_from_os2db(db_obj, os_obj)
-    db_obj.save()
+    base.update_changed(
+        db_obj, lambda obj: _convert_port_from_os2db(obj, os_obj))
+
+
+@shared_task
+@base.serialized('port', fold=False)
+def sync_port_apply(port_id, os_obj):
+    """Update the port from a notification payload (`port_from_payload`)
+    instead of fetching it from Neutron."""
+    db_obj = db_get_port(port_id)
+    if db_obj is None:
+        LOG.warning("Could not found port %s in db, pass to update..."
+                    % port_id)
+        return
+    if base.is_outdated(os_obj.get('updated_at'), db_obj.os_updated_at):
+        LOG.info("Pass outdated payload of port %s: %s" % (
+            port_id, os_obj.get('updated_at')))
+        return
+
+    base.update_changed(
+        db_obj, lambda obj: _convert_port_from_os2db(obj, os_obj))
 
 
 @shared_task
+@base.serialized('network')
 def sync_network_delete(network_id):
     db_obj = db_get_network(network_id)
     if db_obj is None:
@@ -310,6 +390,7 @@ def sync_network_delete(network_id):
 
 
 @shared_task
+@base.serialized('network')
 def sync_network_create(network_id):
     db_obj = db_get_network(network_id)
     if db_obj:
@@ -317,7 +398,8 @@ def sync_network_create(network_id):
                     % network_id)
         return
 
-    os_obj = base.neutron_api().show_network(network_id=network_id)
+    os_obj = base.neutron_api().show_network(network_id=network_id,
+                                             fields=NETWORK_FIELDS)
     if not os_obj:
         LOG.error("Unknown network %s in openstack..." % network_id)
         return
@@ -332,6 +414,7 @@ def sync_network_create(network_id):
 
 
 @shared_task
+@base.serialized('network')
 def sync_network_update(network_id):
     db_obj = db_get_network(network_id)
     if db_obj is None:
@@ -339,15 +422,16 @@ def sync_network_update(network_id):
                     % network_id)
         return
 
-    os_obj = base.neutron_api().show_network(network_id=network_id)
+    os_obj = base.neutron_api().show_network(network_id=network_id,
+                                             fields=NETWORK_FIELDS)
     if not os_obj:
         LOG.error("Unknown network %s in openstack, will remove residual db data..." % network_id)
         db_obj.delete()
         return
 
     # Update existed info
-    _convert_network_from_os2db(db_obj, os_obj)
-    db_obj.save()
+    base.update_changed(
+        db_obj, lambda obj: _convert_network_from_os2db(obj, os_obj))
 
     # sync network ports
     _do_network_ports_sync(network_id)
@@ -1,11 +1,19 @@
 
+import contextlib
+import contextvars
 import logging
+import time
 
+from concurrent import futures
+
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.db import connection
 
 from celery import shared_task
 
 from sync import osapi
+from sync import stats
 from sync.uum import api as uum_api
 from sync import models
 
@@ -16,6 +24,7 @@ from . import network
 from . import keypair
 from . import instance
 from . import volume
+from . import lookup
 
 LOG = logging.getLogger(__name__)
 
@@ -47,9 +56,27 @@ def _create_auth_user(user):
         defaults={'username': user_name})
 
 
+@contextlib.contextmanager
+def _sync_run_phase(run_id, phase):
+    """Collect the stats of a sync phase, saved into the SyncRun if any."""
+    run_stats = stats.RunStats()
+    try:
+        with stats.collect(run_stats), stats.phase(phase):
+            yield run_stats
+    finally:
+        LOG.info("Sync phase %s stats: %s" % (phase, run_stats.to_dict()))
+        if run_id:
+            models.SyncRun.finish_phase(run_id, phase, run_stats)
+
+
 @shared_task
-def do_admin_sync():
-    """Sync admin/global resources"""
+def do_admin_sync(full=False, run_id=None):
+    """Sync admin/global resources, `full` skips the incremental syncs"""
+    with _sync_run_phase(run_id, 'admin'):
+        _admin_sync(full)
+
+
+def _admin_sync(full=False):
     admin_user = _make_admin_user_info()
     admin_project = admin_user.get('projects', [])[0]
 
@@ -57,29 +84,42 @@ def do_admin_sync():
     _create_auth_user(admin_user)
 
     # sync flavors: [global]
-    flavor.do_flavors_sync()
+    with stats.phase('flavor'):
+        flavor.do_flavors_sync()
+    # rebuild flavor lookup index on next use
+    lookup.FLAVORS.invalidate()
 
     # sync volume types: [global]
-    volume_type.do_volume_types_sync()
+    with stats.phase('volume_type'):
+        volume_type.do_volume_types_sync()
 
     # sync images: [global]
-    image.do_images_sync()
+    with stats.phase('image'):
+        image.do_images_sync(full=full)
 
     # sync networks: [global]
-    network.do_networks_sync()
+    with stats.phase('network'):
+        network.do_networks_sync(full=full)
 
     # sync admin resources:
-    _sync_user_project_resources(admin_user, admin_project)
+    _sync_user_keypairs(admin_user, admin_project)
+    _sync_project_resources(admin_user, admin_project, full)
 
 
-def _sync_user_project_resources(user, project):
-    """Sync user/project resources"""
-    # sync keypairs
-    keypair.do_key_pairs_sync(user, project)
+def _sync_user_keypairs(user, project):
+    """Sync the keypairs of an OpenStack user, once for all its projects"""
+    with stats.phase('keypair'):
+        keypair.do_key_pairs_sync(user, project)
+
+
+def _sync_project_resources(user, project, full=False):
+    """Sync project resources"""
     # sync instances
-    instance.do_instances_sync(user, project)
+    with stats.phase('instance'):
+        instance.do_instances_sync(user, project, full)
     # sync volumes
-    volume.do_volumes_sync(user, project)
+    with stats.phase('volume'):
+        volume.do_volumes_sync(user, project, full)
 
 
 @shared_task
@@ -95,12 +135,44 @@ def sync_user_projects_from_uum():
         models.User.create_or_get(user)
 
 
+def _timed_sync(sync_fn, user, *args):
+    """Run `sync_fn(user, *args)`, return its duration and error if any."""
+    start = time.monotonic()
+    error = None
+    try:
+        sync_fn(user, *args)
+    except Exception as ex:
+        LOG.exception(ex)
+        error = str(ex)
+    finally:
+        # called from pool threads, each one holds its own db connection
+        connection.close()
+    return {
+        'user_id': user.get('userId'),
+        'duration': round(time.monotonic() - start, 3),
+        'error': error,
+    }
+
+
 @shared_task
-def do_tenants_sync():
-    """Sync uum mapped tenants resources"""
-    synced_projects = set()
+def do_tenants_sync(concurrency=None, full=False, run_id=None):
+    """Sync uum mapped tenants resources
+
+    Projects are synced by a pool of at most `concurrency` threads
+    (SYNC_TENANT_CONCURRENCY by default) to bound the load on Nova/Cinder.
+    """
+    with _sync_run_phase(run_id, 'tenants'):
+        return _tenants_sync(concurrency, full)
+
+
+def _tenants_sync(concurrency=None, full=False):
+    concurrency = concurrency or settings.SYNC_TENANT_CONCURRENCY
+    synced_projects = {}
+    # an OpenStack user may be member of several projects, its keypairs
+    # are synced once, with its first project
+    synced_users = {}
 
-    def _sync_user_resources(user):
+    def _collect_user_projects(user):
         if not user:
             LOG.warning("User info is None, pass to sync...")
             return
@@ -114,18 +186,20 @@ def do_tenants_sync():
         LOG.debug("Got %s projects for user: %s"
                   % (len(projects), user.get('relUserId')))
 
+        rel_user_id = user.get('relUserId')
+        if rel_user_id and projects:
+            synced_users.setdefault(rel_user_id, (user, projects[0]))
+
         for project in projects:
             project_id = project.get('id')
             if project_id in synced_projects:
                 LOG.warning("Project: %s already synced, pass ..."
                             % project_id)
                 continue
+            # record project to sync with its first user
+            synced_projects[project_id] = (user, project)
 
-            # sync user resources by project
-            _sync_user_project_resources(user, project)
-            # record synced project
-            synced_projects.add(project_id)
-
+    start = time.monotonic()
     # sync from uum to db
     sync_user_projects_from_uum()
     # get all from db
@@ -138,16 +212,55 @@ def do_tenants_sync():
             continue
         # create or get tenant auth user
         _create_auth_user(user)
-        # sync user resources
-        _sync_user_resources(user)
+        # collect user projects to sync
+        _collect_user_projects(user)
+
+    LOG.info("Start to sync %s projects, %s users with concurrency: %s ..."
+             % (len(synced_projects), len(synced_users), concurrency))
+
+    # sync user keypairs and project resources, one job each
+    results = {'keypairs': {}, 'projects': {}}
+    with futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        # each thread records into the stats of this sync run
+        jobs = {
+            executor.submit(contextvars.copy_context().run, _timed_sync,
+                            _sync_user_keypairs, user, project):
+                ('keypairs', rel_user_id)
+            for rel_user_id, (user, project) in synced_users.items()
+        }
+        jobs.update({
+            executor.submit(contextvars.copy_context().run, _timed_sync,
+                            _sync_project_resources, user, project, full):
+                ('projects', project_id)
+            for project_id, (user, project) in synced_projects.items()
+        })
+        for job in futures.as_completed(jobs):
+            kind, key = jobs[job]
+            results[kind][key] = job.result()
+
+    result = {
+        'duration': round(time.monotonic() - start, 3),
+        'projects': results['projects'],
+        'keypairs': results['keypairs'],
+        'errors': sum(1 for kind in results.values()
+                      for r in kind.values() if r['error']),
+    }
+    LOG.info("Tenants sync done in %ss, %s projects, %s users, %s errors"
+             % (result['duration'], len(results['projects']),
+                len(results['keypairs']), result['errors']))
+    return result
 
 
-@shared_task
-def do_all_sync():
+@shared_task(bind=True)
+def do_all_sync(self, full=False):
+    run = models.SyncRun.objects.create(task_id=self.request.id, full=full,
+                                        pending=['admin', 'tenants'])
+
     LOG.info("Start to sync global and admin resources...")
-    do_admin_sync.delay()
+    do_admin_sync.delay(full=full, run_id=run.id)
 
     LOG.info("Start to sync tenants' resources...")
-    do_tenants_sync.delay()
+    do_tenants_sync.delay(full=full, run_id=run.id)
 
-    LOG.info("Sync Done!")
+    LOG.info("Sync run: %s started" % run.id)
+    return run.id
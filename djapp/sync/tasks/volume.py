@@ -1,18 +1,19 @@
 
 import logging
 
-from django.utils import timezone
 from celery import shared_task
 
 from djapp import models
 from sync import osapi
 
 from . import base
+from . import lookup
 
 LOG = logging.getLogger(__name__)
 
 
-def _convert_volume_from_os2db(db_obj, os_obj, user=None, project=None):
+def _convert_volume_from_os2db(db_obj, os_obj, user=None, project=None,
+                               server_names=None):
     """ OpenStack Volume to_dict:
     {
         'id': 'acc5260b-af73-4295-9439-f7bf406bf104',
@@ -52,6 +53,8 @@ def _convert_volume_from_os2db(db_obj, os_obj, user=None, project=None):
         'os-vol-mig-status-attr:name_id': None,
         'os-vol-tenant-attr:tenant_id': '752df3ea70724f44acc088a0f0313579'
     }
+
+    `server_names` is an optional lookup.ServerNameResolver of the sync run.
     """
     db_obj.id = os_obj.get('id')
     db_obj.name = os_obj.get('name') or db_obj.id
@@ -87,57 +90,105 @@ def _convert_volume_from_os2db(db_obj, os_obj, user=None, project=None):
 
         db_obj.server_id = attachment.get('server_id')
 
-        server = base.nova_api().show_server(db_obj.server_id)
-        if server:
-            db_obj.server_name = server.to_dict().get('name')
+        if server_names is not None:
+            db_obj.server_name = server_names.get(db_obj.server_id)
+        else:
+            server = base.nova_api().show_server(db_obj.server_id)
+            if server:
+                db_obj.server_name = server.to_dict().get('name')
 
     else:
         db_obj.attach_status = 'detached'
 
     db_obj.attachments = attachments
     db_obj.cluster_name = os_obj.get('os-vol-host-attr:host')
+    db_obj.os_updated_at = base.parse_time(os_obj.get('updated_at'))
+
+
+VOLUME_PAYLOAD_FIELDS = ('volume_id', 'tenant_id', 'status', 'size', 'host')
+
 
-    db_obj.created_at = timezone.now()
-    db_obj.updated_at = timezone.now()
+def volume_from_payload(payload, sent_at=None):
+    """Build the volume dict `_convert_volume_from_os2db` reads from a
+    Cinder volume notification payload:
+    {
+        'volume_id': 'acc5260b-af73-4295-9439-f7bf406bf104',
+        'display_name': '1',
+        'display_description': None,
+        'tenant_id': '752df3ea70724f44acc088a0f0313579',
+        'status': 'in-use',
+        'size': 1,
+        'host': 'control@lvm-1#lvm-1',
+        'volume_attachment': [{
+            'id': 'e3ac6e6a-4bef-4e79-9a91-63f2263bd895',
+            'instance_uuid': 'b8a5030a-06a7-4f8c-a3b6-723a1f92c35f',
+            'attached_host': 'control',
+            'mountpoint': '/dev/vdd',
+            'attach_status': 'attached',
+            'attach_time': '2021-11-22T02:27:18.000000',
+            ...
+        }],
+        ...
+    }
+
+    The payload has no bootable flag and only the volume type id, those
+    are kept from the db row, nor an update time: `sent_at`, the time of
+    the notification, stands for it. Return None when a required field is
+    missing, the volume must be fetched from Cinder then.
+    """
+    attachments = payload.get('volume_attachment')
+    if (any(payload.get(field) is None for field in VOLUME_PAYLOAD_FIELDS) or
+            not isinstance(attachments, list) or
+            not all(isinstance(att, dict) for att in attachments)):
+        return None
+
+    volume_id = payload['volume_id']
+    return {
+        'id': volume_id,
+        'name': payload.get('display_name'),
+        'description': payload.get('display_description'),
+        'os-vol-tenant-attr:tenant_id': payload['tenant_id'],
+        'status': payload['status'],
+        'size': payload['size'],
+        'os-vol-host-attr:host': payload['host'],
+        'updated_at': payload.get('updated_at') or sent_at,
+        'attachments': [{
+            'id': volume_id,
+            'attachment_id': att.get('id'),
+            'volume_id': volume_id,
+            'server_id': att.get('instance_uuid'),
+            'host_name': att.get('attached_host'),
+            'device': att.get('mountpoint'),
+            'attached_at': att.get('attach_time'),
+        } for att in attachments if att.get('attach_status') == 'attached'],
+    }
 
 
 @shared_task
-def do_volumes_sync(user=None, project=None):
+def do_volumes_sync(user=None, project=None, full=False):
     project_id = project.get('id') if project else osapi.get_project_id()
-    # get project volumes:
+    mark = base.Watermark('volume', project_id, full)
+    # get project volumes, page by page:
     db_objects = models.Volume.objects.filter(project_id=project_id)
-    os_objects = base.cinder_api().get_volumes(project_id=project_id)
+    os_pages = base.cinder_api().iter_volumes(project_id=project_id,
+                                              changed_since=mark.since)
 
-    os_objects = (os_obj.to_dict() for os_obj in os_objects)
-    os_objects = [os_obj for os_obj in os_objects
-                  if os_obj.get('os-vol-tenant-attr:tenant_id') == project_id]
+    LOG.info("Start to syncing Volumes for project: %s since: %s ..."
+             % (project_id, mark.since))
 
-    LOG.info("Start to syncing Volumes for project: %s ..." % project_id)
+    server_names = lookup.ServerNameResolver(project_id)
 
-    def _remove_volume(db_obj):
-        LOG.info("Remove unknown volume: %s" % db_obj.id)
-        db_obj.delete()
-
-    def _create_volume(os_obj):
-        LOG.info("Create a new volume: %s" % os_obj.get('id'))
-        db_obj = models.Volume()
-        _convert_volume_from_os2db(db_obj, os_obj, user, project)
-        # save to db:
-        db_obj.save()
+    def _convert_volume(db_obj, os_obj):
+        _convert_volume_from_os2db(db_obj, os_obj, user, project, server_names)
 
-    def _update_volume(db_obj, os_obj):
-        LOG.info("Update existed volume: %s" % db_obj.id)
-        _convert_volume_from_os2db(db_obj, os_obj, user, project)
-        # update to db:
-        db_obj.save()
-
-    base.alg_sync(db_objects=db_objects,
-                  db_obj_key_fn=lambda obj: str(obj.id),
-                  os_objects=os_objects,
-                  os_obj_key_fn=lambda obj: obj.get('id'),
-                  create_db_fn=_create_volume,
-                  update_db_fn=_update_volume,
-                  remove_db_fn=_remove_volume)
+    result = base.alg_stream_sync(model=models.Volume,
+                                  db_objects=db_objects,
+                                  os_pages=os_pages,
+                                  os_obj_key_fn=lambda obj: obj.get('id'),
+                                  convert_fn=_convert_volume,
+                                  partial=not mark.is_full)
+    mark.commit(result)
+    return result
 
 
 def db_get_volume(volume_id):
@@ -148,6 +199,7 @@ def db_get_volume(volume_id):
 
 
 @shared_task
+@base.serialized('volume')
 def sync_volume_delete(volume_id):
     db_obj = db_get_volume(volume_id)
     if not db_obj:
@@ -160,6 +212,7 @@ def sync_volume_delete(volume_id):
 
 
 @shared_task
+@base.serialized('volume')
 def sync_volume_create(volume_id):
     db_obj = db_get_volume(volume_id)
     if db_obj:
@@ -179,6 +232,7 @@ def sync_volume_create(volume_id):
 
 
 @shared_task
+@base.serialized('volume')
 def sync_volume_update(volume_id):
     db_obj = db_get_volume(volume_id)
     if not db_obj:
@@ -194,6 +248,26 @@ def sync_volume_update(volume_id):
         return
 
     # Update existed info
-    _convert_volume_from_os2db(db_obj, os_obj.to_dict())
-    db_obj.save()
+    base.update_changed(
+        db_obj, lambda obj: _convert_volume_from_os2db(obj, os_obj.to_dict()))
+
+
+@shared_task
+@base.serialized('volume', fold=False)
+def sync_volume_apply(volume_id, os_obj):
+    """Update the volume from a notification payload (`volume_from_payload`)
+    instead of fetching it from Cinder."""
+    db_obj = db_get_volume(volume_id)
+    if not db_obj:
+        LOG.warning("Could not found volume %s in db, pass to update ..."
+                    % volume_id)
+        return
+    if base.is_outdated(os_obj.get('updated_at'), db_obj.os_updated_at):
+        LOG.info("Pass outdated payload of volume %s: %s" % (
+            volume_id, os_obj.get('updated_at')))
+        return
 
+    os_obj.setdefault('bootable', 'true' if db_obj.is_bootable else 'false')
+    os_obj.setdefault('volume_type', db_obj.volume_type)
+    base.update_changed(
+        db_obj, lambda obj: _convert_volume_from_os2db(obj, os_obj))
@@ -38,27 +38,9 @@ def do_volume_types_sync():
 
     LOG.info("Start to syncing VolumeTypes  ...")
 
-    def _remove_volume_type(db_obj):
-        LOG.info("Remove unknown volume type: %s" % db_obj.id)
-        db_obj.delete()
-
-    def _create_volume_type(os_obj):
-        LOG.info("Create a new volume type: %s" % os_obj['id'])
-        db_obj = models.VolumeType()
-        _convert_volume_type_from_os2db(db_obj, os_obj)
-        # save to db:
-        db_obj.save()
-
-    def _update_volume_type(db_obj, os_obj):
-        LOG.info("Update existed volume type: %s" % db_obj.id)
-        _convert_volume_type_from_os2db(db_obj, os_obj)
-        # update to db
-        db_obj.save()
-
-    base.alg_sync(db_objects=db_objects,
-                  db_obj_key_fn=lambda obj: str(obj.id),
-                  os_objects=os_objects,
-                  os_obj_key_fn=lambda obj: obj.get('id'),
-                  create_db_fn=_create_volume_type,
-                  update_db_fn=_update_volume_type,
-                  remove_db_fn=_remove_volume_type)
+    return base.alg_bulk_sync(model=models.VolumeType,
+                              db_objects=db_objects,
+                              db_obj_key_fn=lambda obj: str(obj.id),
+                              os_objects=os_objects,
+                              os_obj_key_fn=lambda obj: obj.get('id'),
+                              convert_fn=_convert_volume_type_from_os2db)
@@ -0,0 +1,383 @@
+import datetime
+import time
+import types
+import uuid
+from unittest import mock
+
+from django.test import SimpleTestCase
+from django.test import TestCase
+from django.utils import timezone
+
+from djapp import locks
+from djapp import models
+from djapp.cache import LRUCache
+from sync import models as sync_models
+from sync import osapi
+from sync.notifications import dispatcher
+from sync.tasks import base
+from sync.tasks import keypair as keypair_tasks
+from sync.tasks import lookup
+from sync.tasks import user as user_tasks
+from sync.tasks import volume as volume_tasks
+
+
+def _task(name):
+    task = mock.Mock()
+    task.name = name
+    return task
+
+
+def _group_mock():
+    """celery.group stand-in that consumes the signatures it is given."""
+    def side_effect(signatures):
+        list(signatures)
+        return mock.DEFAULT
+    return mock.Mock(side_effect=side_effect)
+
+
+def _convert_flavor(db_obj, os_obj):
+    db_obj.id = os_obj['id']
+    db_obj.name = os_obj['name']
+    db_obj.creator_id = os_obj.get('creator_id')
+
+
+class BulkSyncTestCase(TestCase):
+
+    def test_failing_row_keeps_chunk(self):
+        # exists outside of the synced rows, its create conflicts
+        conflict = models.Flavor.objects.create(id=uuid.uuid4(), name='a',
+                                                creator_id='other')
+        os_objects = [{'id': str(conflict.id), 'name': 'a'}] + [
+            {'id': str(uuid.uuid4()), 'name': 'f%d' % i} for i in range(4)]
+
+        result = base.alg_bulk_sync(
+            model=models.Flavor,
+            db_objects=models.Flavor.objects.filter(creator_id=None),
+            db_obj_key_fn=lambda obj: str(obj.pk),
+            os_objects=os_objects,
+            os_obj_key_fn=lambda obj: obj['id'],
+            convert_fn=_convert_flavor)
+
+        self.assertEqual(result['created'], 4)
+        self.assertEqual(result['errors'], 1)
+        self.assertEqual(
+            models.Flavor.objects.filter(creator_id=None).count(), 4)
+
+
+class UpdateChangedTestCase(TestCase):
+
+    def test_reordered_json_keys_unchanged(self):
+        attachment = {'server_id': str(uuid.uuid4()), 'device': '/dev/vdb',
+                      'attachment_id': str(uuid.uuid4())}
+        volume = models.Volume.objects.create(
+            id=uuid.uuid4(), name='v', status='in-use',
+            attachments=[attachment])
+        volume.refresh_from_db()
+
+        def _convert(db_obj):
+            db_obj.attachments = [dict(reversed(list(attachment.items())))]
+
+        self.assertEqual(base.update_changed(volume, _convert), [])
+
+        def _convert_device(db_obj):
+            db_obj.attachments = [dict(attachment, device='/dev/vdc')]
+
+        self.assertEqual(base.update_changed(volume, _convert_device),
+                         ['attachments'])
+
+
+class StreamSyncTestCase(TestCase):
+
+    def test_invalid_pk_skipped(self):
+        flavor_id = str(uuid.uuid4())
+        os_pages = [[{'id': '1', 'name': 'm1.tiny'},
+                     {'id': flavor_id, 'name': 'm1.small'}]]
+
+        result = base.alg_stream_sync(
+            model=models.Flavor,
+            db_objects=models.Flavor.objects.all(),
+            os_pages=os_pages,
+            os_obj_key_fn=lambda obj: obj['id'],
+            convert_fn=_convert_flavor)
+
+        self.assertEqual(result['skipped'], 1)
+        self.assertEqual(result['created'], 1)
+        self.assertEqual(
+            [str(pk) for pk in models.Flavor.objects.values_list('pk', flat=True)],
+            [flavor_id])
+
+
+class ChangedVolumesTestCase(TestCase):
+
+    def test_never_updated_volumes_listed(self):
+        since = timezone.now() - datetime.timedelta(hours=1)
+        recent = (since + datetime.timedelta(minutes=5)).isoformat()
+        old = (since - datetime.timedelta(minutes=5)).isoformat()
+        volumes = [
+            {'id': 'updated', 'updated_at': recent, 'created_at': old},
+            {'id': 'old', 'updated_at': old, 'created_at': old},
+            {'id': 'new', 'updated_at': None, 'created_at': recent},
+            {'id': 'never', 'updated_at': None, 'created_at': old},
+        ]
+
+        def _list(detailed, search_opts, marker, limit, sort):
+            field = sort.split(':')[0]
+            return [mock.Mock(to_dict=lambda obj=obj: obj)
+                    for obj in sorted(volumes, reverse=True,
+                                      key=lambda obj: (obj[field] is not None,
+                                                       obj[field] or ''))]
+
+        client = mock.Mock()
+        client.volumes.list.side_effect = _list
+        pages = osapi.CinderAPI(client).iter_volumes(changed_since=since)
+
+        self.assertEqual([obj['id'] for page in pages for obj in page],
+                         ['updated', 'new'])
+
+
+class ApplyPayloadTestCase(TestCase):
+
+    def _payload(self, volume_id, status, sent_at):
+        return volume_tasks.volume_from_payload({
+            'volume_id': str(volume_id), 'display_name': 'v',
+            'tenant_id': 'p1', 'status': status, 'size': 1,
+            'host': 'control@lvm-1#lvm-1', 'volume_attachment': [],
+        }, sent_at)
+
+    def test_outdated_payload_skipped(self):
+        volume = models.Volume.objects.create(
+            id=uuid.uuid4(), status='creating', project_id='p1')
+        newer = self._payload(volume.id, 'available',
+                              '2021-11-22 02:27:20.000000')
+        older = self._payload(volume.id, 'creating',
+                              '2021-11-22 02:27:18.000000')
+
+        volume_tasks.sync_volume_apply(str(volume.id), newer)
+        volume_tasks.sync_volume_apply(str(volume.id), older)
+
+        volume.refresh_from_db()
+        self.assertEqual(volume.status, 'available')
+        self.assertEqual(volume.os_updated_at,
+                         base.parse_time('2021-11-22T02:27:20Z'))
+
+
+class WatermarkTestCase(TestCase):
+
+    def test_commit_keeps_later_mark(self):
+        later = base.Watermark('volume', 'p', full=True)
+        earlier = base.Watermark('volume', 'p', full=True)
+        earlier.started = later.started - datetime.timedelta(minutes=1)
+
+        later.commit()
+        earlier.commit()
+
+        mark = sync_models.SyncWatermark.objects.get(resource='volume',
+                                                     project_id='p')
+        self.assertEqual(mark.changed_since, later.started)
+        self.assertEqual(mark.full_synced_at, later.started)
+
+
+class KeypairSyncTestCase(TestCase):
+
+    def test_pages_synced_by_name(self):
+        project = {'id': str(uuid.uuid4()), 'tenantId': 1}
+        user = {'userId': 1, 'relUserId': 'os-a'}
+        models.Keypair.objects.create(name='a', rel_user_id='os-a',
+                                      project_id=project['id'],
+                                      fingerprint='old')
+        models.Keypair.objects.create(name='gone', rel_user_id='os-a',
+                                      project_id=project['id'])
+        pages = [[types.SimpleNamespace(name=name, fingerprint=name,
+                                        public_key='k', type='ssh')]
+                 for name in ('a', 'b')]
+        with mock.patch.object(base, 'nova_api') as nova_api:
+            nova_api.return_value.iter_keypairs.return_value = iter(pages)
+            result = keypair_tasks.do_key_pairs_sync(user, project)
+
+        self.assertEqual(
+            dict(models.Keypair.objects.values_list('name', 'fingerprint')),
+            {'a': 'a', 'b': 'b'})
+        self.assertEqual((result['created'], result['updated'],
+                          result['removed']), (1, 1, 1))
+
+
+class LookupTestCase(SimpleTestCase):
+
+    def test_keypair_indexes_bounded(self):
+        with mock.patch.object(lookup, '_KEYPAIRS', LRUCache(maxsize=2)):
+            first = lookup._user_keypairs_index('u1')
+            self.assertIs(lookup._user_keypairs_index('u1'), first)
+            lookup._user_keypairs_index('u2')
+            lookup._user_keypairs_index('u3')
+            self.assertEqual(len(lookup._KEYPAIRS), 2)
+            self.assertIsNot(lookup._user_keypairs_index('u1'), first)
+
+
+class TenantsSyncTestCase(TestCase):
+
+    def test_keypairs_synced_once_per_user(self):
+        users = [
+            {'userId': 1, 'userName': 'a', 'relUserId': 'os-a',
+             'projects': [{'id': 'p1'}, {'id': 'p2'}]},
+            {'userId': 2, 'userName': 'b', 'relUserId': 'os-a',
+             'projects': [{'id': 'p3'}]},
+            {'userId': 3, 'userName': 'c', 'relUserId': 'os-c',
+             'projects': [{'id': 'p1'}]},
+        ]
+        with mock.patch.object(user_tasks, 'sync_user_projects_from_uum'), \
+                mock.patch.object(user_tasks, '_create_auth_user'), \
+                mock.patch.object(sync_models.User, 'all',
+                                  return_value=users), \
+                mock.patch.object(user_tasks.keypair,
+                                  'do_key_pairs_sync') as keypairs_sync, \
+                mock.patch.object(user_tasks,
+                                  '_sync_project_resources') as project_sync:
+            result = user_tasks._tenants_sync(concurrency=2)
+
+        self.assertEqual(
+            sorted(call.args[0]['relUserId']
+                   for call in keypairs_sync.call_args_list),
+            ['os-a', 'os-c'])
+        self.assertEqual(
+            sorted(call.args[1]['id'] for call in project_sync.call_args_list),
+            ['p1', 'p2', 'p3'])
+        self.assertEqual(result['errors'], 0)
+
+
+class DispatcherTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.dispatcher = dispatcher.CoalescingDispatcher(window=60)
+        self.dispatcher.start()
+        self.addCleanup(self.dispatcher.stop)
+
+    def test_apply_keeps_pending_update(self):
+        fetch, apply = _task('fetch'), _task('apply')
+        self.dispatcher.submit('volume', 'v1', dispatcher.KIND_UPDATE, fetch)
+        self.dispatcher.submit('volume', 'v1', dispatcher.KIND_APPLY, apply,
+                               {'status': 'available'})
+        self.dispatcher.stop()
+
+        fetch.delay.assert_called_once_with('v1')
+        apply.delay.assert_not_called()
+
+    def test_window_keeps_latest_payload(self):
+        apply = _task('apply')
+        for status in ('extending', 'available'):
+            self.dispatcher.submit('volume', 'v1', dispatcher.KIND_APPLY,
+                                   apply, {'status': status})
+        self.dispatcher.stop()
+
+        apply.delay.assert_called_once_with('v1', {'status': 'available'})
+        self.assertEqual(self.dispatcher.stats()['received'], 2)
+        self.assertEqual(self.dispatcher.stats()['dispatched'], 1)
+
+    def test_strongest_kind_wins(self):
+        update, delete = _task('update'), _task('delete')
+        self.dispatcher.submit('volume', 'v1', dispatcher.KIND_UPDATE, update)
+        self.dispatcher.submit('volume', 'v1', dispatcher.KIND_DELETE, delete)
+        self.dispatcher.submit('volume', 'v1', dispatcher.KIND_UPDATE, update)
+        self.dispatcher.stop()
+
+        delete.delay.assert_called_once_with('v1')
+        update.delay.assert_not_called()
+
+    def test_stop_flushes_pending(self):
+        update = _task('update')
+        with mock.patch.object(dispatcher, 'group', _group_mock()) as group:
+            for volume_id in ('v1', 'v2'):
+                self.dispatcher.submit('volume', volume_id,
+                                       dispatcher.KIND_UPDATE, update)
+            self.assertEqual(self.dispatcher.stats()['pending'], 2)
+            self.dispatcher.stop()
+
+        group.return_value.apply_async.assert_called_once_with()
+        self.assertEqual(sorted(call.args for call in update.s.call_args_list),
+                         [('v1',), ('v2',)])
+        self.assertEqual(self.dispatcher.stats()['pending'], 0)
+
+    def test_window_closes(self):
+        self.dispatcher.stop()
+        self.dispatcher = dispatcher.CoalescingDispatcher(window=0.05)
+        self.dispatcher.start()
+        update = _task('update')
+        self.dispatcher.submit('volume', 'v1', dispatcher.KIND_UPDATE, update)
+        for _ in range(100):
+            if update.delay.called:
+                break
+            time.sleep(0.01)
+        update.delay.assert_called_once_with('v1')
+
+
+class DispatcherBatchTestCase(SimpleTestCase):
+
+    def test_batch_publishes_one_group(self):
+        unbuffered = dispatcher.CoalescingDispatcher()
+        update, delete = _task('update'), _task('delete')
+        with mock.patch.object(dispatcher, 'group', _group_mock()) as group:
+            with unbuffered.batch():
+                unbuffered.submit('volume', 'v1', dispatcher.KIND_UPDATE,
+                                  update)
+                unbuffered.submit('port', 'p1', dispatcher.KIND_DELETE,
+                                  delete)
+                group.assert_not_called()
+
+        group.assert_called_once()
+        group.return_value.apply_async.assert_called_once_with()
+        update.s.assert_called_once_with('v1')
+        delete.s.assert_called_once_with('p1')
+        update.delay.assert_not_called()
+        self.assertEqual(unbuffered.stats()['dispatched'], 2)
+
+
+class _Locks(object):
+    """In memory advisory locks."""
+
+    def __init__(self):
+        self.held = set()
+
+    def try_lock(self, key):
+        if key in self.held:
+            return False
+        self.held.add(key)
+        return True
+
+    def lock(self, key):
+        assert key not in self.held, "would block"
+        self.held.add(key)
+
+    def unlock(self, key):
+        self.held.discard(key)
+
+
+class SerializedTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.locks = _Locks()
+        for name in ('try_lock', 'lock', 'unlock'):
+            patcher = mock.patch.object(locks, name,
+                                        getattr(self.locks, name))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(locks, 'is_supported', lambda: True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.pending = locks.advisory_key('volume', 'v1', 'pending')
+
+    def test_runs_and_releases(self):
+        task = mock.Mock(__name__='sync', return_value='done')
+        self.assertEqual(base.serialized('volume')(task)('v1', 1), 'done')
+        task.assert_called_once_with('v1', 1)
+        self.assertEqual(self.locks.held, set())
+
+    def test_folds_when_one_is_pending(self):
+        task = mock.Mock(__name__='sync')
+        self.locks.held.add(self.pending)
+        self.assertIsNone(base.serialized('volume')(task)('v1'))
+        task.assert_not_called()
+
+    def test_apply_does_not_fold(self):
+        task = mock.Mock(__name__='apply')
+        self.locks.held.add(self.pending)
+        base.serialized('volume', fold=False)(task)('v1', {'status': 'x'})
+        task.assert_called_once_with('v1', {'status': 'x'})
@@ -6,11 +6,14 @@ from rest_framework.decorators import action
 from rest_framework.response import Response
 
 from rest_framework import serializers
+from django.shortcuts import get_object_or_404
 from django_celery_results.models import TaskResult
+from celery import states
 
 from drf_yasg import openapi
 from drf_yasg.utils import swagger_auto_schema
 
+from sync import models
 from sync.tasks import user
 
 LOG = logging.getLogger(__name__)
@@ -23,6 +26,13 @@ class TaskSerializer(serializers.ModelSerializer):
         fields = '__all__'
 
 
+class SyncRunSerializer(serializers.ModelSerializer):
+
+    class Meta:
+        model = models.SyncRun
+        fields = '__all__'
+
+
 class TaskViewSet(viewsets.GenericViewSet):
     queryset = TaskResult.objects.all()
     serializer_class = TaskSerializer
@@ -39,7 +49,11 @@ class TaskViewSet(viewsets.GenericViewSet):
         return Response(serializer.data)
 
     def retrieve(self, request, *args, **kwargs):
-        task = self.get_object()
+        task = self.get_queryset().filter(task_id=kwargs['task_id']).first()
+        if task is None:
+            # results are only stored once a worker started the task
+            return Response({'task_id': kwargs['task_id'],
+                             'status': states.PENDING})
         serializer = self.get_serializer(task)
         return Response(serializer.data)
 
@@ -63,3 +77,21 @@ class TaskViewSet(viewsets.GenericViewSet):
             'task_id': task.task_id,
         }
         return Response(data=data, status=status.HTTP_202_ACCEPTED)
+
+    @action(detail=False, methods=['get'], serializer_class=SyncRunSerializer)
+    def runs(self, request, *args, **kwargs):
+        """Sync runs, latest first."""
+        queryset = models.SyncRun.objects.all()
+        page = self.paginate_queryset(queryset)
+        if page:
+            serializer = self.get_serializer(page, many=True)
+            return self.get_paginated_response(serializer.data)
+        serializer = self.get_serializer(queryset, many=True)
+        return Response(serializer.data)
+
+    @action(detail=False, methods=['get'], serializer_class=SyncRunSerializer,
+            url_path=r'runs/(?P<run_id>[0-9]+)')
+    def run(self, request, run_id=None, *args, **kwargs):
+        run = get_object_or_404(models.SyncRun, pk=run_id)
+        serializer = self.get_serializer(run)
+        return Response(serializer.data)